@@ -17,6 +17,7 @@ application = ProtocolTypeRouter({
     "websocket": AuthMiddlewareStack(
         URLRouter([
             re_path(r"^ws/market/inbox/$", ChatConsumer.as_asgi()),
+            re_path(r"^ws/market/notifications/$", NotificationConsumer.as_asgi()),
             re_path(r"^ws/market/(?P<listing_id>\w+)/$", ListingConsumer.as_asgi()),
         ])
     ),
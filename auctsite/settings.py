@@ -65,6 +65,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'market.context_processors.nav_badges',
             ],
         },
     },
@@ -155,10 +156,64 @@ else:
 
 CHANNEL_LAYERS = ch_layer_temp
 
+# JSON encoder of websocket frames: "json", "ujson" or "orjson" (optional packages)
+WEBSOCKET_JSON_BACKEND = os.environ.get("WEBSOCKET_JSON_BACKEND", "json")
+
+# Seconds to coalesce bid updates of one listing into one broadcast, 0 broadcasts every accepted bid
+BID_BROADCAST_WINDOW = float(os.environ.get("BID_BROADCAST_WINDOW", "0"))
+
+# Cache keeps sequence numbers and ring buffer of recent listing events, page fragments and navigation badges.
+# ASGI processes, Celery workers and management commands all write it, so they must share one cache:
+# when Redis is deployed for channels (NOSQL_ENGINE) the cache is in its database CACHE_REDIS_DB,
+# process local memory is only for tests and single process development
+if is_no_sql_engine:
+    cache_backend = "django_redis.cache.RedisCache"
+    cache_location = (f"redis://{os.environ.get('NOSQL_HOST', 'localhost')}:{os.environ.get('NOSQL_PORT', '6379')}"
+                      f"/{os.environ.get('CACHE_REDIS_DB', '1')}")
+else:
+    cache_backend = "django.core.cache.backends.locmem.LocMemCache"
+    cache_location = ""
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get("CACHE_BACKEND", cache_backend),
+        "LOCATION": os.environ.get("CACHE_LOCATION", cache_location),
+    }
+}
+LISTING_EVENTS_BUFFER_SIZE = int(os.environ.get("LISTING_EVENTS_BUFFER_SIZE", "256"))
+LISTING_EVENTS_TTL = int(os.environ.get("LISTING_EVENTS_TTL", "3600"))
+# Seconds to keep api/<id>/last_bid response, new bid drops it earlier
+LAST_BID_CACHE_TTL = int(os.environ.get("LAST_BID_CACHE_TTL", "5"))
+# Seconds to keep rendered fragments of listing's page, they are also versioned by bids, comments and edits
+LISTING_FRAGMENT_CACHE_TTL = int(os.environ.get("LISTING_FRAGMENT_CACHE_TTL", "600"))
+# Number of the newest comments rendered on listing's page and loaded per request of older comments
+COMMENTS_PAGE_SIZE = int(os.environ.get("COMMENTS_PAGE_SIZE", "20"))
+# Seconds to keep user's navigation badges, watchlist, bids, listings and settlement writes drop them earlier
+NAV_BADGES_CACHE_TTL = int(os.environ.get("NAV_BADGES_CACHE_TTL", "300"))
+# Number of listings on one page of listings grids
+LISTINGS_PAGE_SIZE = int(os.environ.get("LISTINGS_PAGE_SIZE", "24"))
+
 # Celery configs
 CELERY_BROKER_URL = os.environ.get("CELERY_BROKER", "redis://redis:6379/0")
 CELERY_RESULT_BACKEND = os.environ.get("CELERY_BACKEND", "redis://redis:6379/0")
 
+# Ended listings are closed by one periodic task instead of a countdown task per listing
+AUCTION_CLOSER_INTERVAL = float(os.environ.get("AUCTION_CLOSER_INTERVAL", "5"))
+AUCTION_CLOSER_BATCH_SIZE = int(os.environ.get("AUCTION_CLOSER_BATCH_SIZE", "500"))
+CELERY_BEAT_SCHEDULE = {
+    "close-expired-listings": {
+        "task": "market.tasks.close_expired_listings",
+        "schedule": AUCTION_CLOSER_INTERVAL,
+    },
+    "notify-ending-soon": {
+        "task": "market.tasks.notify_ending_soon",
+        "schedule": float(os.environ.get("ENDING_SOON_INTERVAL", "30")),
+    },
+}
+# Watchers are notified when listing ends in less than this number of seconds
+ENDING_SOON_WINDOW = int(os.environ.get("ENDING_SOON_WINDOW", "300"))
+# Number of watchers read from watchlist table and notified at once
+WATCHERS_NOTIFY_CHUNK_SIZE = int(os.environ.get("WATCHERS_NOTIFY_CHUNK_SIZE", "1000"))
+
 # Main url for manage media
 MEDIA_URL = '/media/'
 
@@ -0,0 +1,77 @@
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import AuctionListing, Bid
+from .notifications import notify_outbid
+
+MAX_BID_VALUE = Decimal("99999.99")
+
+# Reasons of rejected bid
+OWNER = "owner"
+NON_NUMERIC = "non_numeric"
+OUT_OF_RANGE = "out_of_range"
+INACTIVE = "inactive"
+TOO_LOW = "too_low"
+
+BidResult = namedtuple("BidResult", ["accepted", "price", "bid", "reason"])
+
+
+def to_bid_value(value):
+    """
+    Convert given value to Decimal with 2 decimal places. Raise ValueError if value is not a valid number.
+    """
+    try:
+        value = Decimal(str(value).strip())
+    except (InvalidOperation, ValueError):
+        raise ValueError(f"Non-numeric bid value: {value!r}")
+    if not value.is_finite():
+        raise ValueError(f"Non-numeric bid value: {value!r}")
+    return value.quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+
+def place_bid(listing, user, value):
+    """
+    Accept new bid of "user" on "listing" only if it is bigger than listing's current price.
+
+    Acceptance is decided by one conditional UPDATE of the listing row
+    (UPDATE ... WHERE current_price < value), so concurrent bids are serialized by
+    the database and never accept the same or lower value twice.
+    Outbid leader is notified after commit.
+    Returns BidResult with authoritative listing's price.
+    """
+    if listing.user_id == user.id:
+        return BidResult(False, listing.current_price, None, OWNER)
+    try:
+        value = to_bid_value(value)
+    except ValueError:
+        return BidResult(False, listing.current_price, None, NON_NUMERIC)
+    if value > MAX_BID_VALUE:
+        return BidResult(False, listing.current_price, None, OUT_OF_RANGE)
+
+    now = timezone.now()
+    with transaction.atomic():
+        # Listing closer runs periodically, so ended listing may still be active for a while
+        claimed = AuctionListing.objects.filter(
+            Q(current_price__lt=value) | Q(current_price__isnull=True, startBid__lt=value),
+            pk=listing.pk,
+            active=True,
+            endDate__gt=now,
+        ).update(current_price=value)
+        if claimed:
+            # Listing row is locked by the claim, so this is the leader the new bid replaces
+            previous_leader_id = AuctionListing.objects.filter(pk=listing.pk).values_list(
+                "leading_bid__user_id", flat=True
+            ).first()
+            bid = Bid.objects.create(value=value, listing_id=listing.pk, user=user, date=now)
+            if previous_leader_id and previous_leader_id != user.id:
+                notify_outbid(listing, previous_leader_id, value)
+            return BidResult(True, value, bid, None)
+
+    current = AuctionListing.objects.filter(pk=listing.pk).values("current_price", "active", "endDate").first()
+    if current is None or not current["active"] or current["endDate"] <= now:
+        return BidResult(False, current and current["current_price"], None, INACTIVE)
+    return BidResult(False, current["current_price"], None, TOO_LOW)
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+PROCESS_LOCAL_CACHES = ("django.core.cache.backends.locmem.LocMemCache",)
+
+
+@register()
+def shared_cache_check(app_configs, **kwargs):
+    """
+    Settlement in Celery workers and management commands invalidate navigation badges, page fragments
+    and number listing events in the cache, the web process sees it only if the cache is shared.
+    """
+    if settings.DEBUG or settings.CACHES["default"]["BACKEND"] not in PROCESS_LOCAL_CACHES:
+        return []
+    return [Warning(
+        "Default cache is local to every process.",
+        hint="Celery workers and management commands write the cache read by web processes, "
+             "configure a shared cache (set NOSQL_ENGINE for Redis or CACHE_BACKEND and CACHE_LOCATION).",
+        id="market.W001",
+    )]
@@ -1,149 +1,206 @@
-from django.urls import reverse
-from django.db.models import Max
+from django.conf import settings
+from django.db import transaction
 from django.utils import dateformat
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+import asyncio
 import json
+from urllib.parse import parse_qs
+from . import bidding
+from .bidding import place_bid
+from .events import listing_event, missed_frames
+from .frames import frame_event
+from .notifications import user_group
 from .models import *
+from .tasks import settle_listing
+
+
+def get_bid_summary(listing_id):
+    listing = AuctionListing.objects.filter(pk=listing_id).values(
+        'current_price', 'bid_count', 'leading_bid__user__username'
+    ).get()
+    return {
+        'new_bid_set': f"{float(listing['current_price'])}",
+        'bid_count': listing['bid_count'],
+        'leader': listing['leading_bid__user__username'],
+    }
+
+
+class BidBroadcastCoalescer:
+    """
+    Broadcast bid updates of a listing at most once per window.
+    The first accepted bid schedules a flush, bids accepted until the flush are covered by it,
+    because flush reads the latest price, bid count and leader of the listing.
+    """
+
+    def __init__(self):
+        self.pending = set()
+        self.tasks = set()
+
+    def schedule(self, channel_layer, listing_id, window):
+        if listing_id in self.pending:
+            return
+        self.pending.add(listing_id)
+        task = asyncio.get_running_loop().create_task(self.flush(channel_layer, listing_id, window))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def flush(self, channel_layer, listing_id, window):
+        try:
+            await asyncio.sleep(window)
+        finally:
+            # Bids accepted after this point schedule the next flush
+            self.pending.discard(listing_id)
+        summary = await database_sync_to_async(get_bid_summary)(listing_id)
+        event = await sync_to_async(listing_event)(listing_id, 'new_bid_listing', summary)
+        await channel_layer.group_send(f"market_{listing_id}", event)
+
 
+bid_broadcasts = BidBroadcastCoalescer()
 
-def toFixed(numObj, digits=0):
-    return f"{numObj:.{digits}f}"
 
+class ListingConsumer(AsyncWebsocketConsumer):
+    # Sockets connected with "resume_from" get events with sequence numbers
+    resume_from = None
 
-class ListingConsumer(WebsocketConsumer):
-    def connect(self):
+    async def connect(self):
         self.user = self.scope['user']
         self.room_name = self.scope['url_route']['kwargs']['listing_id']
         self.room_group_name = 'market_%s' % self.room_name
+        try:
+            self.resume_from = int(parse_qs(self.scope['query_string'].decode())['resume_from'][0])
+        except (KeyError, ValueError):
+            pass
+        if self.user.is_authenticated:
+            # Resolved once per connection and carried in group events, so receivers do no storage work
+            self.user_display = {
+                'username': f"{self.user.username}",
+                'avatar': self.user.avatar.url,
+            }
 
         # Join room group by listing url
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.room_group_name,
             self.channel_name
         )
-        self.accept()
+        await self.accept()
+        if self.resume_from is not None:
+            await self.replay_missed_events()
+
+    async def replay_missed_events(self):
+        """
+        Send events which the socket missed since "resume_from" sequence number.
+        Socket joins the group before replay, so client skips live events with already seen "seq".
+        """
+        try:
+            listing_id = int(self.room_name)
+        except ValueError:
+            return
+        frames = await sync_to_async(missed_frames)(listing_id, self.resume_from)
+        if frames is None:
+            await self.send(text_data=json.dumps({
+                'resync': 'yes',
+            }))
+        else:
+            for frame in frames:
+                await self.send(text_data=frame)
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         # Leave room group
-        async_to_sync(self.channel_layer.group_discard)(
+        await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
-    def new_comment(self, comment_text, listing):
+    @database_sync_to_async
+    def get_listing(self, listing_id):
+        return AuctionListing.objects.get(pk=int(listing_id))
+
+    @database_sync_to_async
+    def create_comment(self, listing, comment_text):
+        return Comment.objects.create(listing=listing, user=self.user, date=timezone.localtime(), text=comment_text)
+
+    async def new_comment(self, comment_text, listing):
         try:
             comment_text = comment_text.strip()
         except AttributeError:
-            self.send(text_data=json.dumps({
+            await self.send(text_data=json.dumps({
                 'error-socket': "Wrong data type. Only string values for New Comment allowed",
             }))
         else:
             if comment_text:
-                date = timezone.localtime()
-                comment = Comment.objects.create(listing=listing, user=self.user, date=date, text=comment_text)
-                comment.save()
-                async_to_sync(self.channel_layer.group_send)(
-                    self.room_group_name,
-                    {
-                        'type': 'post_new_comment',
-                        'comment': f"{comment.text}",
-                        'username': f"{comment.user.username}",
-                        'avatar': self.user.avatar.url,
-                        'comment_date': f'{dateformat.format(comment.date, "M d, h:i a")}'
-                    }
-                )
+                comment = await self.create_comment(listing, comment_text)
+                event = await sync_to_async(listing_event)(listing.id, 'post_new_comment', {
+                    'comment_id': comment.id,
+                    'comment': f"{comment.text}",
+                    'username': self.user_display['username'],
+                    'comment_date': f'{dateformat.format(comment.date, "M d, h:i a")}',
+                    'avatar': self.user_display['avatar'],
+                })
+                await self.channel_layer.group_send(self.room_group_name, event)
             else:
-                self.send(text_data=json.dumps({
+                await self.send(text_data=json.dumps({
                     'error-socket': "New comment text can't be empty string",
                 }))
 
-    def end_listing(self, listing):
-        if self.user == listing.user:
-            listing.active = False
-            listing.save()
-            # Define winner
-            bids = Bid.objects.filter(listing=listing)
-            if not bids:
-                async_to_sync(self.channel_layer.group_send)(
-                    self.room_group_name,
-                    {
-                        'type': 'listing_winner',
-                        'win_user_id': f"{listing.user.id}"
-                    }
-                )
-            else:
-                last_bid = bids.order_by('-value')[0]
-                win_user = last_bid.user
-                win_user.winlist.add(listing)
-                new_message_text = f"Hi, you won my listing at link http://127.0.0.1:8000{reverse('market:details', kwargs={'listing_id': listing.id})}"
-                try:
-                    chat = Chat.objects.filter(members=win_user).get(members=listing.user)
-                except Chat.DoesNotExist:
-                    chat = Chat.objects.create()
-                    chat.members.add(win_user, listing.user)
-
-                new_message = Message.objects.create(chat=chat, sender_id=listing.user.id, text=new_message_text)
+    @staticmethod
+    def end_listing_now(listing_id):
+        AuctionListing.objects.filter(pk=listing_id, active=True, endDate__gt=timezone.now()).update(
+            endDate=timezone.now()
+        )
 
-                async_to_sync(self.channel_layer.group_send)(
-                    self.room_group_name,
-                    {
-                        'type': 'listing_winner',
-                        'win_user_id': f"{win_user.id}"
-                    }
-                )
+    async def end_listing(self, listing):
+        if self.user.id == listing.user_id:
+            # Ended listing takes no more bids and is closed by close_expired_listings if the task is lost
+            await database_sync_to_async(self.end_listing_now)(listing.id)
+            # Settlement runs in celery worker, winner is announced to the group when it's done
+            await sync_to_async(settle_listing.delay)(listing.id)
         else:
-            self.send(text_data=json.dumps({
+            await self.send(text_data=json.dumps({
                 'error-socket': "Only listing's owner can end the listing",
             }))
 
-    def new_bid_placement(self, listing, new_bid):
-        if listing.user == self.user:
-            self.send(text_data=json.dumps({
+    async def new_bid_placement(self, listing, new_bid):
+        result = await database_sync_to_async(place_bid)(listing, self.user, new_bid)
+        if result.reason == bidding.OWNER:
+            await self.send(text_data=json.dumps({
                 'error-socket': "You can't do bids on own listing.",
             }))
+        elif result.reason == bidding.NON_NUMERIC:
+            await self.send(text_data=json.dumps({
+                'error-socket': "Non-numeric new-bid value or does not exist.",
+            }))
+        elif not result.accepted:
+            await self.send(text_data=json.dumps({
+                'error-socket': "Wrong new-bid value.",
+            }))
+        elif settings.BID_BROADCAST_WINDOW:
+            # Bidder gets immediate acknowledgement, watchers get only the latest state once per window
+            await self.send(text_data=json.dumps({
+                'new_bid_set': f"{float(result.price)}",
+                'send_self': 'yes',
+            }))
+            bid_broadcasts.schedule(self.channel_layer, listing.id, settings.BID_BROADCAST_WINDOW)
         else:
-            try:
-                new_bid = float(new_bid)
-            except ValueError:
-                self.send(text_data=json.dumps({
-                    'error-socket': "Non-numeric new-bid value or does not exist.",
-                }))
-            else:
-                new_bid = float(toFixed(new_bid, 2))
-                bids = Bid.objects.filter(listing=listing)
-                date = timezone.now()
-                max_value = bids.aggregate(Max('value'))['value__max']
-                if max_value is None:
-                    max_value = 0
-                if max_value < new_bid <= 99999.99 and new_bid > float(listing.startBid):
-                    new_bid_object = Bid.objects.create(value=float(new_bid), user=self.user, listing=listing,
-                                                        date=date)
-                    new_bid_object.save()
-                    # Send message to room group
-                    async_to_sync(self.channel_layer.group_send)(
-                        self.room_group_name,
-                        {
-                            'type': 'new_bid_listing',
-                            'new_bid_set': f"{new_bid_object.value}"
-                        }
-                    )
-                else:
-                    self.send(text_data=json.dumps({
-                        'error-socket': "Wrong new-bid value.",
-                    }))
+            # Send message to room group
+            event = await sync_to_async(listing_event)(listing.id, 'new_bid_listing', {
+                'new_bid_set': f"{float(result.price)}",
+            })
+            await self.channel_layer.group_send(self.room_group_name, event)
 
     # Receive message from WebSocket
-    def receive(self, text_data):
+    async def receive(self, text_data):
         task_checker = False
         if self.user.is_active == True and self.user.is_anonymous == False:
             text_data_json = json.loads(text_data)
             try:
-                listing = AuctionListing.objects.get(pk=int(text_data_json['listing_id']))
-            except (KeyError, AuctionListing.DoesNotExist):
-                self.send(text_data=json.dumps({
+                listing = await self.get_listing(text_data_json['listing_id'])
+            except (KeyError, ValueError, TypeError, AuctionListing.DoesNotExist):
+                await self.send(text_data=json.dumps({
                     'error-socket': "Can't find the asked listing object.",
                 }))
+                return
             if listing.active:
                 try:
                     comment_text = text_data_json['post_comment']
@@ -151,7 +208,7 @@ class ListingConsumer(WebsocketConsumer):
                     pass
                 else:
                     task_checker = True
-                    self.new_comment(comment_text, listing)
+                    await self.new_comment(comment_text, listing)
 
                 try:
                     new_bid = text_data_json['newbid']
@@ -159,168 +216,189 @@ class ListingConsumer(WebsocketConsumer):
                     pass
                 else:
                     task_checker = True
-                    self.new_bid_placement(listing, new_bid)
+                    await self.new_bid_placement(listing, new_bid)
+
+                if 'endlisting' in text_data_json:
+                    task_checker = True
+                    await self.end_listing(listing)
                 if not task_checker:
-                    self.send(text_data=json.dumps({
+                    await self.send(text_data=json.dumps({
                         'error-socket': "No tasks to do was given",
                     }))
             else:
-                self.send(text_data=json.dumps({
+                await self.send(text_data=json.dumps({
                     'error-socket': "Listing is not active. You can't do anything.",
                 }))
         else:
-            self.send(text_data=json.dumps({
+            await self.send(text_data=json.dumps({
                 'error-socket': "You must be logged in to make some actions.",
             }))
 
-    def new_bid_listing(self, event):
-        new_bid_set = event['new_bid_set']
-
-        # Send message to WebSocket
+    # Group events carry frames serialized once by the sender, handlers forward them as is
+    async def forward(self, event):
+        await self.send(text_data=event['frame'] if self.resume_from is None else event['seq_frame'])
 
-        self.send(text_data=json.dumps({
-            'new_bid_set': new_bid_set,
-        }))
+    async def new_bid_listing(self, event):
+        await self.forward(event)
 
-    def post_new_comment(self, event):
-        comment = event['comment']
-        username = event['username']
-        comment_date = event['comment_date']
+    async def post_new_comment(self, event):
+        await self.forward(event)
 
-        # Send message to WebSocket
-        self.send(text_data=json.dumps({
-            'comment': comment,
-            'username': username,
-            'comment_date': comment_date,
-            'avatar': self.user.avatar.url
-        }))
+    async def listing_winner(self, event):
+        await self.forward(event)
 
-    def listing_winner(self, event):
-        win_user_id = event['win_user_id']
 
-        # Send message to WebSocket
-        self.send(text_data=json.dumps({
-            'win_user_id': win_user_id,
-        }))
-
-
-class ChatConsumer(WebsocketConsumer):
-    def connect(self):
+class ChatConsumer(AsyncWebsocketConsumer):
+    async def connect(self):
         self.user = self.scope['user']
 
         if self.user.is_authenticated:
             self.room_group_name = f"chat_{self.user.id}"
 
             # Join room group
-            async_to_sync(self.channel_layer.group_add)(
+            await self.channel_layer.group_add(
                 self.room_group_name,
                 self.channel_name
             )
-            self.accept()
+            await self.accept()
         else:
-            self.close()
+            await self.close()
 
-    def disconnect(self, close_code):
+    async def disconnect(self, close_code):
         # Leave room group
         try:
-            async_to_sync(self.channel_layer.group_discard)(
+            await self.channel_layer.group_discard(
                 self.room_group_name,
                 self.channel_name
             )
         except AttributeError:
             pass
 
+    @database_sync_to_async
+    def chat_exists(self, chat_id):
+        return Chat.objects.filter(pk=chat_id).exists()
+
+    @database_sync_to_async
+    def get_receiver_id(self, chat_id):
+        """
+        Return id of other member of the chat, None if there is no other member.
+        Raise PermissionError if connected user is not member of the chat.
+        """
+        members = Chat.members.through.objects.filter(chat_id=chat_id)
+        if not members.filter(user_id=self.user.id).exists():
+            raise PermissionError
+        return members.exclude(user_id=self.user.id).values_list('user_id', flat=True).first()
+
+    @database_sync_to_async
+    def create_message(self, chat_id, receiver_id, message_text):
+        """
+        Create new message, which increments receiver's inbox counter, the cost doesn't depend on chat history.
+        Returns message and new receiver's inbox value.
+        """
+        with transaction.atomic():
+            message = Message.objects.create(
+                text=message_text,
+                sender_id=self.user.id,
+                receiver_id=receiver_id,
+                chat_id=chat_id,
+                date=timezone.localtime()
+            )
+            receiver_inbox = User.objects.filter(pk=receiver_id).values_list('inbox', flat=True).get()
+        return message, receiver_inbox
+
     # Receive message from WebSocket
-    def new_message_chat_exist(self, chat, message_text):
-        date = timezone.localtime()
+    async def new_message_chat_exist(self, chat_id, message_text):
         try:
             message_text = message_text.strip()
         except (AttributeError, ValueError):
-            self.send(text_data=json.dumps(
+            await self.send(text_data=json.dumps(
                 {
                     'error-socket': "Message text must be string value",
                 }))
         else:
             if message_text and len(message_text) <= 300:
-                sender = User.objects.get(username=f"{self.user}")
-                # chat_members = chat.members.all()
-                if sender in chat.members.all():
-                    receiver = chat.members.exclude(pk=sender.id).first()
-                    if receiver:
-                        message = Message.objects.create(
-                            text=message_text,
-                            sender=sender,
-                            receiver=receiver,
-                            chat=chat,
-                            date=date
-                        )
-                        message.save()
-
-                        unread_messages_all = 0
-
-                        for message_item in chat.message_set.filter(sender_id=sender.id):
-                            if message_item.unread:  # BooleanField 'unread' in Message
-                                unread_messages_all += 1
-
-                        receiver.inbox = unread_messages_all
-                        receiver.save()
-
-                        async_to_sync(self.channel_layer.group_send)(
-                            f'chat_{receiver.id}',
-                            {
-                                'type': 'chat_message',
-                                'message': message.text,
-                                'user_inbox': receiver.inbox,
-                                'message_date': f'{dateformat.format(message.date, "M d, h:i a")}'
-                            }
-                        )
-                        self.send(text_data=json.dumps(
-                            {
-                                'message': message.text,
-                                'sender': sender,
-                                'user': self.user,
-                                'message_date': f'{dateformat.format(message.date, "M d, h:i a")}',
-                                'send_self': 'yes',
-                            }))
-                    else:
-                        self.send(text_data=json.dumps(
-                            {
-                                'error-socket': "You're single user in the chat, can't send message",
-                            }))
-                else:
-                    self.send(text_data=json.dumps(
+                try:
+                    receiver_id = await self.get_receiver_id(chat_id)
+                except PermissionError:
+                    await self.send(text_data=json.dumps(
                         {
                             'error-socket': "Sender is not member of the chat. Can't send the message",
                         }))
-
+                    return
+                if receiver_id:
+                    message, receiver_inbox = await self.create_message(chat_id, receiver_id, message_text)
+                    message_date = f'{dateformat.format(message.date, "M d, h:i a")}'
+
+                    await self.channel_layer.group_send(
+                        f'chat_{receiver_id}',
+                        frame_event('chat_message', {
+                            'message': message.text,
+                            'user_inbox': receiver_inbox,
+                            'message_date': message_date,
+                        })
+                    )
+                    await self.send(text_data=json.dumps(
+                        {
+                            'message': message.text,
+                            'message_date': message_date,
+                            'send_self': 'yes',
+                        }))
+                else:
+                    await self.send(text_data=json.dumps(
+                        {
+                            'error-socket': "You're single user in the chat, can't send message",
+                        }))
             else:
-                self.send(text_data=json.dumps(
+                await self.send(text_data=json.dumps(
                     {
                         'error-socket': "The message text can't be empty string",
                     }))
 
-    def receive(self, text_data):
+    async def receive(self, text_data):
         text_data_json = json.loads(text_data)
         try:
-            chat = Chat.objects.get(pk=int(text_data_json['chat_id']))
+            chat_id = int(text_data_json['chat_id'])
             message_text = text_data_json['new_message_text']
-        except (KeyError, Chat.DoesNotExist):
-            self.send(text_data=json.dumps(
+            if not await self.chat_exists(chat_id):
+                raise Chat.DoesNotExist
+        except (KeyError, ValueError, TypeError, Chat.DoesNotExist):
+            await self.send(text_data=json.dumps(
                 {
                     'error-socket': "The message requires correct 'chat_id' and 'new_message_text' values",
                 }))
         else:
-            self.new_message_chat_exist(chat, message_text)
-
-    # Receive message from room group
-    def chat_message(self, event):
-        message = event['message']
-        user_inbox = event['user_inbox']
-        message_date = event['message_date']
-
-        # Send message to WebSocket
-        self.send(text_data=json.dumps({
-            'message': message,
-            'user_inbox': user_inbox,
-            'message_date': message_date,
-        }))
+            await self.new_message_chat_exist(chat_id, message_text)
+
+    # Receive message from room group, frame is serialized once by the sender
+    async def chat_message(self, event):
+        await self.send(text_data=event['frame'])
+
+
+class NotificationConsumer(AsyncWebsocketConsumer):
+    """
+    Personal notifications of the user (outbid, ending soon listings), sent to user_<user_id> group.
+    """
+    async def connect(self):
+        self.user = self.scope['user']
+
+        if self.user.is_authenticated:
+            self.group_name = user_group(self.user.id)
+            await self.channel_layer.group_add(
+                self.group_name,
+                self.channel_name
+            )
+            await self.accept()
+        else:
+            await self.close()
+
+    async def disconnect(self, close_code):
+        try:
+            await self.channel_layer.group_discard(
+                self.group_name,
+                self.channel_name
+            )
+        except AttributeError:
+            pass
+
+    async def notification(self, event):
+        await self.send(text_data=event['frame'])
@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Exists, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils.functional import SimpleLazyObject
+
+from .models import AuctionListing, Bid, User, nav_badges_key
+
+
+def count_subquery(through):
+    return Coalesce(Subquery(
+        through.objects.filter(user_id=OuterRef('pk')).order_by().values('user_id').annotate(
+            total=Count('id')
+        ).values('total'),
+        output_field=IntegerField(),
+    ), 0)
+
+
+def get_nav_badges(user_id):
+    """
+    Navigation badges of layout.html, one query on cache miss. Cache entry is dropped by invalidate_nav_badges().
+    Inbox counter isn't cached, it comes with the user row loaded by authentication.
+    """
+    badges = cache.get(nav_badges_key(user_id))
+    if badges is None:
+        badges = User.objects.filter(pk=user_id).annotate(
+            watchlist_count=count_subquery(User.watchlist.through),
+            winlist_count=count_subquery(User.winlist.through),
+            has_bids=Exists(Bid.objects.filter(user_id=OuterRef('pk'))),
+            has_listings=Exists(AuctionListing.objects.filter(user_id=OuterRef('pk'))),
+        ).values('watchlist_count', 'winlist_count', 'has_bids', 'has_listings').first() or {}
+        cache.set(nav_badges_key(user_id), badges, settings.NAV_BADGES_CACHE_TTL)
+    return badges
+
+
+def nav_badges(request):
+    """
+    Add lazy "nav_badges" of authenticated user, templates without navigation don't touch the cache.
+    """
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return {}
+    return {'nav_badges': SimpleLazyObject(lambda: get_nav_badges(user.id))}
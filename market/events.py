@@ -0,0 +1,50 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from .frames import make_frame
+
+
+def seq_key(listing_id):
+    return f"listing_events_seq_{listing_id}"
+
+
+def slot_key(listing_id, seq):
+    return f"listing_events_{listing_id}_{seq % settings.LISTING_EVENTS_BUFFER_SIZE}"
+
+
+def last_seq(listing_id):
+    return cache.get(seq_key(listing_id), 0)
+
+
+def listing_event(listing_id, event_type, payload):
+    """
+    Build group event of the listing with the next sequence number and remember it in ring buffer
+    of recent events, slot of event is its sequence number modulo LISTING_EVENTS_BUFFER_SIZE.
+    Event carries frame for plain sockets and frame with "seq" for sockets which resume.
+    Events are sent by ASGI processes and by Celery workers (settlement), so the cache must be shared
+    by them (see CACHES in settings), otherwise every process numbers events on its own.
+    """
+    cache.add(seq_key(listing_id), 0, timeout=None)
+    seq = cache.incr(seq_key(listing_id))
+    seq_frame = make_frame({**payload, 'seq': seq})
+    cache.set(slot_key(listing_id, seq), (seq, seq_frame), timeout=settings.LISTING_EVENTS_TTL)
+    return {'type': event_type, 'frame': make_frame(payload), 'seq_frame': seq_frame}
+
+
+def missed_frames(listing_id, resume_from):
+    """
+    Return frames of the listing's events after "resume_from" sequence number.
+    None if some of them already left ring buffer and client has to reload the listing.
+    """
+    current = last_seq(listing_id)
+    if resume_from > current or current - resume_from > settings.LISTING_EVENTS_BUFFER_SIZE:
+        return None
+    seqs = range(resume_from + 1, current + 1)
+    slots = cache.get_many([slot_key(listing_id, seq) for seq in seqs])
+    frames = []
+    for seq in seqs:
+        stored = slots.get(slot_key(listing_id, seq))
+        if stored is None or stored[0] != seq:
+            return None
+        frames.append(stored[1])
+    return frames
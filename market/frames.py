@@ -0,0 +1,40 @@
+from importlib import import_module
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# Dumps function of every supported backend, text result is required by websocket send
+BACKENDS = {
+    "json": lambda module: module.dumps,
+    "ujson": lambda module: module.dumps,
+    "orjson": lambda module: lambda payload: module.dumps(payload).decode(),
+}
+
+_dumps = {}
+
+
+def get_dumps(backend=None):
+    """
+    Return dumps function of given JSON backend or WEBSOCKET_JSON_BACKEND from settings.
+    """
+    backend = backend or settings.WEBSOCKET_JSON_BACKEND
+    if backend not in _dumps:
+        if backend not in BACKENDS:
+            raise ImproperlyConfigured(f"Unknown WEBSOCKET_JSON_BACKEND {backend!r}, choose from {sorted(BACKENDS)}")
+        try:
+            module = import_module(backend)
+        except ImportError:
+            raise ImproperlyConfigured(f"WEBSOCKET_JSON_BACKEND {backend!r} is not installed")
+        _dumps[backend] = BACKENDS[backend](module)
+    return _dumps[backend]
+
+
+def make_frame(payload):
+    """
+    Serialize websocket frame once on the sender side, group event carries ready text to every socket.
+    """
+    return get_dumps()(payload)
+
+
+def frame_event(event_type, payload):
+    return {'type': event_type, 'frame': make_frame(payload)}
@@ -0,0 +1,58 @@
+import datetime
+import math
+
+from django.utils import timezone
+
+NO_IMAGE_URL = (
+    "https://upload.wikimedia.org/wikipedia/commons/thumb/a/ac/No_image_available.svg/1024px"
+    "-No_image_available.svg.png"
+)
+MAX_NAME_LENGTH = 32
+MAX_DESCRIPTION_LENGTH = 150
+MIN_START_BID = 0.01
+MAX_START_BID = 99999.00
+
+# Messages of rejected listing
+FIELDS_MISSING = "All fields must be filled in, check this out and try again"
+NO_CATEGORY = "You didn't select a category"
+NAME_TOO_LONG = "Name for listing is too long, must be less than 33"
+START_BID_OUT_OF_RANGE = "Listing Start Price must be bigger than 0.01 and less than 99999.00"
+DESCRIPTION_TOO_LONG = "Description length must be less than 151"
+EXPIRE_TIME_OUT_OF_RANGE = "Listing expire time is out of range"
+
+
+def clean_listing(name, description, start_bid, hours, image, category, now=None):
+    """
+    Validate fields of new listing by createListing rules and return AuctionListing field values.
+    "category" is already resolved Category or None. Raise ValueError with message for the user.
+    """
+    try:
+        hours = int(hours)
+        start_bid = float(start_bid)
+    except (TypeError, ValueError):
+        raise ValueError(FIELDS_MISSING)
+    name = f"{name}"
+    description = f"{description}"
+    if category is None:
+        raise ValueError(NO_CATEGORY)
+    if len(name) > MAX_NAME_LENGTH:
+        raise ValueError(NAME_TOO_LONG)
+    if not math.isfinite(start_bid) or start_bid > MAX_START_BID or start_bid < MIN_START_BID:
+        raise ValueError(START_BID_OUT_OF_RANGE)
+    if len(description) > MAX_DESCRIPTION_LENGTH:
+        raise ValueError(DESCRIPTION_TOO_LONG)
+    now = now or timezone.now()
+    try:
+        end_date = now + datetime.timedelta(hours=hours)
+    except OverflowError:
+        raise ValueError(EXPIRE_TIME_OUT_OF_RANGE)
+    return {
+        "name": name,
+        "description": description,
+        "image": image or NO_IMAGE_URL,
+        "category": category,
+        "startBid": start_bid,
+        "creationDate": now,
+        "endDate": end_date,
+        "active": True,
+    }
@@ -0,0 +1,169 @@
+import csv
+import json
+import os
+import sys
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from market.listings import FIELDS_MISSING, clean_listing
+from market.models import AuctionListing, Bid, Category, User, invalidate_nav_badges
+
+FORMATS = ('csv', 'jsonl')
+REQUIRED_FIELDS = ('name', 'description', 'startBid', 'hours')
+EXPORTS = {
+    'listings': (
+        AuctionListing.objects.order_by('id'),
+        ('id', 'name', 'description', 'image', 'category', 'user', 'startBid', 'current_price', 'bid_count',
+         'creationDate', 'endDate', 'active'),
+        ('id', 'name', 'description', 'image', 'category_id', 'user__username', 'startBid', 'current_price',
+         'bid_count', 'creationDate', 'endDate', 'active'),
+    ),
+    'bids': (
+        Bid.objects.order_by('id'),
+        ('id', 'listing', 'user', 'value', 'date'),
+        ('id', 'listing_id', 'user__username', 'value', 'date'),
+    ),
+}
+
+
+def read_rows(stream, file_format):
+    """
+    Yield dicts of rows one by one, whole file is never loaded.
+    """
+    if file_format == 'csv':
+        yield from csv.DictReader(stream)
+        return
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            # Broken line is rejected by validation as a row without fields
+            yield {}
+
+
+def clean_row(row, categories, now):
+    """
+    Validate imported row by createListing rules, "category" column is id of category.
+    """
+    if not isinstance(row, dict) or any(row.get(field) is None for field in REQUIRED_FIELDS):
+        raise ValueError(FIELDS_MISSING)
+    return clean_listing(row['name'], row['description'], row['startBid'], row['hours'], row.get('image') or "",
+                         categories.get(str(row.get('category'))), now=now)
+
+
+def import_listings(stream, file_format, user, chunk_size=1000, on_reject=None):
+    """
+    Create listings of "user" from the stream, every chunk of valid rows is inserted by one bulk_create.
+    "on_reject" is called with row number and message of every invalid row.
+    Returns (imported, rejected) counters.
+    """
+    categories = {str(category.id): category for category in Category.objects.all()}
+    imported = 0
+    rejected = 0
+    rows = enumerate(read_rows(stream, file_format), start=1)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        now = timezone.now()
+        listings = []
+        for number, row in chunk:
+            try:
+                fields = clean_row(row, categories, now)
+            except ValueError as error:
+                rejected += 1
+                if on_reject:
+                    on_reject(number, str(error))
+                continue
+            # bulk_create skips save(), so current_price is set here
+            listings.append(AuctionListing(user=user, current_price=fields['startBid'], **fields))
+        AuctionListing.objects.bulk_create(listings)
+        imported += len(listings)
+    if imported:
+        invalidate_nav_badges(user.id)
+    return imported, rejected
+
+
+def export_rows(stream, file_format, model, chunk_size=1000):
+    """
+    Write listings or bids to the stream, rows are read from the database chunk by chunk.
+    Returns number of exported rows.
+    """
+    queryset, columns, fields = EXPORTS[model]
+    rows = queryset.values_list(*fields).iterator(chunk_size=chunk_size)
+    exported = 0
+    if file_format == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            exported += 1
+    else:
+        for row in rows:
+            stream.write(json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + "\n")
+            exported += 1
+    return exported
+
+
+class Command(BaseCommand):
+    help = "Import listings from CSV or JSON Lines file, export listings or bids to it"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('import', 'export'))
+        parser.add_argument('path', help="File path, '-' for stdin or stdout")
+        parser.add_argument('--format', choices=FORMATS,
+                            help="File format, by default taken from file extension")
+        parser.add_argument('--user', help="Username of the owner of imported listings")
+        parser.add_argument('--model', choices=tuple(EXPORTS), default='listings', help="What to export")
+        parser.add_argument('--chunk-size', type=int, default=1000)
+
+    def get_format(self, options):
+        file_format = options['format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+        if file_format not in FORMATS:
+            raise CommandError(f"Unknown file format, use --format with one of: {', '.join(FORMATS)}")
+        return file_format
+
+    def open(self, path, mode):
+        if path == '-':
+            return sys.stdin if mode == 'r' else self.stdout
+        return open(path, mode, newline='', encoding='utf-8')
+
+    def handle(self, *args, **options):
+        file_format = self.get_format(options)
+        path = options['path']
+        started = time.perf_counter()
+        if options['action'] == 'import':
+            if not options['user']:
+                raise CommandError("--user is required for import")
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError(f"User {options['user']!r} does not exist")
+            stream = self.open(path, 'r')
+            try:
+                imported, rejected = import_listings(
+                    stream, file_format, user, chunk_size=options['chunk_size'],
+                    on_reject=lambda number, message: self.stderr.write(f"Row {number} rejected: {message}"),
+                )
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
+            rows = imported + rejected
+            report = f"Imported {imported} listings, rejected {rejected}"
+        else:
+            stream = self.open(path, 'w')
+            try:
+                rows = export_rows(stream, file_format, options['model'], chunk_size=options['chunk_size'])
+            finally:
+                if stream is not self.stdout:
+                    stream.close()
+            report = f"Exported {rows} {options['model']}"
+        elapsed = time.perf_counter() - started
+        # Exported rows may go to stdout, so the report doesn't mix with them
+        out = self.stderr if path == '-' and options['action'] == 'export' else self.stdout
+        out.write(f"{report} in {elapsed:.2f}s ({rows / elapsed if elapsed else 0:.0f} rows/s)")
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from market.models import AuctionListing
+
+
+def sync_listing_bids(batch_size=500):
+    """
+    Recompute current_price, bid_count and leading_bid of every listing from the Bid table.
+    Returns (checked, repaired) counters.
+    """
+    checked = 0
+    repaired = 0
+    listings = AuctionListing.objects.order_by('id')
+    for listing in listings.iterator(chunk_size=batch_size):
+        with transaction.atomic():
+            if listing.refresh_bid_summary():
+                repaired += 1
+        checked += 1
+    return checked, repaired
+
+
+class Command(BaseCommand):
+    help = "Backfill or repair denormalized bid summary columns of listings"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        checked, repaired = sync_listing_bids(batch_size=options['batch_size'])
+        self.stdout.write(f"Checked {checked} listings, repaired {repaired}")
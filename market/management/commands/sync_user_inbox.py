@@ -0,0 +1,51 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+from market.models import Message, User
+
+
+def repair_inbox(user_ids):
+    """
+    Set inbox counter of given users to the number of their unread messages.
+    Counter is recomputed inside UPDATE, so messages created meanwhile aren't lost.
+    """
+    unread_count = Message.objects.filter(receiver=OuterRef('pk'), unread=True).order_by().values(
+        'receiver'
+    ).annotate(total=Count('id')).values('total')
+    return User.objects.filter(pk__in=user_ids).update(
+        inbox=Coalesce(Subquery(unread_count, output_field=IntegerField()), 0)
+    )
+
+
+def sync_user_inbox(batch_size=500):
+    """
+    Recompute inbox counter of every user from unread messages he received.
+    Returns (checked, repaired) counters.
+    """
+    checked = 0
+    repaired = 0
+    drifted = []
+    users = User.objects.order_by('id').annotate(
+        unread_count=Count('user_receiver', filter=Q(user_receiver__unread=True))
+    ).values_list('id', 'inbox', 'unread_count')
+    for user_id, inbox, unread_count in users.iterator(chunk_size=batch_size):
+        checked += 1
+        if inbox != unread_count:
+            drifted.append(user_id)
+        if len(drifted) >= batch_size:
+            repaired += repair_inbox(drifted)
+            drifted = []
+    if drifted:
+        repaired += repair_inbox(drifted)
+    return checked, repaired
+
+
+class Command(BaseCommand):
+    help = "Backfill or repair inbox counters of users"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        checked, repaired = sync_user_inbox(batch_size=options['batch_size'])
+        self.stdout.write(f"Checked {checked} users, repaired {repaired}")
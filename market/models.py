@@ -1,4 +1,9 @@
-from django.db import models
+import time
+
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Case, F, Q, Value, When
+from django.db.models.functions import Coalesce
 from django.contrib.auth.models import AbstractUser
 from django.utils import timezone
 from django.core import validators
@@ -8,9 +13,30 @@ class User(AbstractUser):
     watchlist = models.ManyToManyField('AuctionListing', blank=True, related_name='userWatchList')
     category = models.ManyToManyField('Category', blank=True, related_name="userCategories")
     winlist = models.ManyToManyField('AuctionListing', blank=True, related_name="userWinListings")
+    # Number of unread messages received by user, maintained by Message.save() and Message.mark_read()
     inbox = models.IntegerField(default=0)
     avatar = models.ImageField(upload_to="images", default="default-user.png")
 
+    def save(self, *args, **kwargs):
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        if adding:
+            invalidate_nav_badges(self.pk)
+
+    def toggle_watchlist(self, listing_id):
+        """
+        Remove listing from user's watchlist or add it if nothing was removed, user row isn't written.
+        Returns True if listing is watched now.
+        """
+        through = User.watchlist.through
+        deleted, _ = through.objects.filter(user_id=self.pk, auctionlisting_id=listing_id).delete()
+        if not deleted:
+            # Concurrent toggle may have inserted the same row already
+            through.objects.bulk_create([through(user_id=self.pk, auctionlisting_id=listing_id)],
+                                        ignore_conflicts=True)
+        invalidate_nav_badges(self.pk)
+        return not deleted
+
 
 class Chat(models.Model):
     members = models.ManyToManyField("User", blank=True, related_name="userChat")
@@ -21,20 +47,58 @@ class Chat(models.Model):
         }
 
 
+def add_unread_messages(counts):
+    """
+    Increase inbox counters of users by one UPDATE, "counts" is dict {user_id: number of new unread messages}.
+    """
+    if counts:
+        User.objects.filter(pk__in=counts).update(inbox=F('inbox') + Case(
+            *[When(pk=user_id, then=Value(count)) for user_id, count in counts.items()],
+            default=Value(0), output_field=models.IntegerField(),
+        ))
+
+
 class Message(models.Model):
     text = models.CharField(max_length=300)
     sender = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
     receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name="user_receiver", null=True)
     chat = models.ForeignKey("Chat", on_delete=models.CASCADE)
     unread = models.BooleanField(default=True)
-    date = models.DateTimeField(default=timezone.now())
+    date = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat', 'date'], name='message_chat_date_idx'),
+            models.Index(fields=['chat'], condition=Q(unread=True), name='message_chat_unread_idx'),
+            models.Index(fields=['receiver'], condition=Q(unread=True), name='message_receiver_unread_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding or not self.unread or self.receiver_id is None:
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # Receiver's unread counter is changed in the same transaction as the insert
+            add_unread_messages({self.receiver_id: 1})
+
+    @staticmethod
+    def mark_read(chat_id, user_id):
+        """
+        Mark unread messages of the chat received by user as read and decrease user's inbox counter by their number.
+        Returns number of marked messages.
+        """
+        with transaction.atomic():
+            marked = Message.objects.filter(chat_id=chat_id, receiver_id=user_id, unread=True).update(unread=False)
+            if marked:
+                User.objects.filter(pk=user_id).update(inbox=F('inbox') - marked)
+        return marked
 
     def serialize(self):
         return {
             "body": self.text,
             "sender": self.sender,
             "receiver": self.receiver,
-            "chat": self.chat.id,
+            "chat": self.chat_id,
             "date": self.date
         }
 
@@ -49,6 +113,11 @@ class Category(models.Model):
         return f"{self.id} : {self.name}"
 
 
+# Price of the listing for sorting and keyset cursors, current_price of listings created before the column
+# was added stays NULL until sync_listing_bids backfills it
+LISTING_PRICE = Coalesce('current_price', 'startBid')
+
+
 class AuctionListing(models.Model):
     name = models.CharField(max_length=32)
     image = models.URLField(blank=True)
@@ -61,10 +130,129 @@ class AuctionListing(models.Model):
     creationDate = models.DateTimeField()
     endDate = models.DateTimeField()
     active = models.BooleanField()
+    # Bid summary maintained by Bid.save(), so hot paths never aggregate the bid table.
+    # current_price equals startBid until the first bid is placed.
+    current_price = models.DecimalField(decimal_places=2, max_digits=7, null=True, blank=True)
+    bid_count = models.PositiveIntegerField(default=0)
+    leading_bid = models.ForeignKey('Bid', on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    # Set once watchers were told that the listing ends soon, see tasks.notify_ending_soon
+    ending_notified = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # Keyset pages of listings grids, one index per grid and sort order (see views.LISTING_GRID_SORTS),
+            # listing_active_end_id_idx also serves the scan of expired listings
+            models.Index(fields=['endDate', 'id'], name='listing_enddate_id_idx'),
+            models.Index(fields=['creationDate', 'id'], name='listing_created_id_idx'),
+            models.Index(fields=['endDate', 'id'], condition=Q(active=True), name='listing_active_end_id_idx'),
+            models.Index(fields=['creationDate', 'id'], condition=Q(active=True), name='listing_active_created_idx'),
+            models.Index(fields=['category', 'endDate', 'id'], name='listing_category_enddate_idx'),
+            models.Index(fields=['category', 'creationDate', 'id'], name='listing_category_created_idx'),
+            # The only index of current_price, which every accepted bid rewrites: one extra index write per bid,
+            # price sort is offered by the grid of active listings only. Indexed expression is LISTING_PRICE
+            models.Index(LISTING_PRICE, F('id'), condition=Q(active=True), name='listing_active_price_idx'),
+        ]
 
     def __str__(self):
         return f"ID: {self.id}\nUser: {self.user}\nName: {self.name}\nCategory: {self.category}\nDescription: {self.description}\nStart Bid: {self.startBid}\nCreated: {self.creationDate}\nEnd at: {self.endDate}\nActive: {self.active}"
 
+    def save(self, *args, **kwargs):
+        if self.current_price is None:
+            self.current_price = self.startBid
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+        bump_listing_version(self.pk)
+        if adding:
+            invalidate_nav_badges(self.user_id)
+
+    def delete(self, *args, **kwargs):
+        # Watchlist, winlist and bids of other users go away with the listing
+        user_ids = set(User.objects.filter(
+            Q(watchlist=self) | Q(winlist=self) | Q(bid__listing=self)
+        ).values_list('id', flat=True))
+        user_ids.add(self.user_id)
+        result = super().delete(*args, **kwargs)
+        invalidate_nav_badges(*user_ids)
+        return result
+
+    def refresh_bid_summary(self):
+        """
+        Recompute current_price, bid_count and leading_bid from the Bid table.
+        Listing row is locked first, so a bid placed meanwhile waits and then updates the repaired values.
+        Among equal bids the latest one leads, like in Bid.save().
+        Returns True if stored values were out of date.
+        """
+        with transaction.atomic():
+            stored = AuctionListing.objects.select_for_update().values(
+                'current_price', 'bid_count', 'leading_bid'
+            ).get(pk=self.pk)
+            bids = Bid.objects.filter(listing=self)
+            leading_bid = bids.order_by('-value', '-id').first()
+            bid_count = bids.count()
+            current_price = leading_bid.value if leading_bid else self.startBid
+            leading_bid_id = leading_bid.id if leading_bid else None
+            self.current_price = current_price
+            self.bid_count = bid_count
+            self.leading_bid_id = leading_bid_id
+            if (stored['current_price'], stored['bid_count'], stored['leading_bid']) == (
+                    current_price, bid_count, leading_bid_id):
+                return False
+            AuctionListing.objects.filter(pk=self.pk).update(
+                current_price=current_price, bid_count=bid_count, leading_bid=leading_bid_id
+            )
+            bump_listing_version(self.pk)
+        return True
+
+
+def last_bid_cache_key(listing_id):
+    return f"last_bid_{listing_id}"
+
+
+def listing_version_key(listing_id):
+    return f"listing_version_{listing_id}"
+
+
+def get_listing_version(listing_id):
+    """
+    Version of the listing's cached page fragments.
+    Lost counter restarts from current time, so fragments of the old counter are never reused.
+    """
+    version = cache.get(listing_version_key(listing_id))
+    if version is None:
+        cache.add(listing_version_key(listing_id), time.time_ns(), timeout=None)
+        version = cache.get(listing_version_key(listing_id))
+    return version
+
+
+def bump_listing_version(listing_id):
+    """
+    Make cached page fragments of the listing outdated. Version is bumped right away and once more
+    after commit, so fragment rendered from not yet committed data is not kept under the new version.
+    """
+    def bump():
+        try:
+            cache.incr(listing_version_key(listing_id))
+        except ValueError:
+            cache.add(listing_version_key(listing_id), time.time_ns(), timeout=None)
+
+    bump()
+    transaction.on_commit(bump)
+
+
+def nav_badges_key(user_id):
+    return f"nav_badges_{user_id}"
+
+
+def invalidate_nav_badges(*user_ids):
+    """
+    Drop cached navigation badges of users, right away and once more after commit like bump_listing_version().
+    Settlement and bulk import call it outside the web process, so the cache must be shared (see checks.py).
+    """
+    keys = [nav_badges_key(user_id) for user_id in user_ids]
+    if keys:
+        cache.delete_many(keys)
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
 
 class Bid(models.Model):
     value = models.DecimalField(decimal_places=2, max_digits=7)
@@ -72,9 +260,45 @@ class Bid(models.Model):
     user = models.ForeignKey('User', on_delete=models.CASCADE)
     date = models.DateTimeField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['listing', 'value'], name='bid_listing_value_idx'),
+            models.Index(fields=['listing', 'date'], name='bid_listing_date_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # Update listing's bid summary in the same transaction as the insert,
+            # among equal bids the latest one leads (see refresh_bid_summary)
+            value = self._meta.get_field('value').to_python(self.value)
+            takes_lead = Q(leading_bid__isnull=True) | Q(current_price__lte=value)
+            AuctionListing.objects.filter(pk=self.listing_id).update(
+                bid_count=F('bid_count') + 1,
+                current_price=Case(When(takes_lead, then=Value(value)), default=F('current_price'),
+                                   output_field=models.DecimalField(decimal_places=2, max_digits=7)),
+                leading_bid=Case(When(takes_lead, then=Value(self.id)), default=F('leading_bid'),
+                                 output_field=models.BigIntegerField()),
+            )
+            # Cached last bid of the listing is dropped only when new bid is visible to readers
+            transaction.on_commit(lambda: cache.delete(last_bid_cache_key(self.listing_id)))
+            bump_listing_version(self.listing_id)
+            invalidate_nav_badges(self.user_id)
+
 
 class Comment(models.Model):
     date = models.DateTimeField()
     user = models.ForeignKey('User', on_delete=models.CASCADE)
     text = models.CharField(max_length=100)
     listing = models.ForeignKey('AuctionListing', on_delete=models.CASCADE)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['listing', 'date'], name='comment_listing_date_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_listing_version(self.listing_id)
@@ -0,0 +1,77 @@
+import asyncio
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from .frames import frame_event
+from .models import AuctionListing, User
+
+
+def user_group(user_id):
+    """
+    Channel group of every socket of the user opened by NotificationConsumer.
+    """
+    return f"user_{user_id}"
+
+
+async def send_to_users(channel_layer, user_ids, event):
+    """
+    Send one already built event to the groups of all given users concurrently.
+    """
+    await asyncio.gather(*[channel_layer.group_send(user_group(user_id), event) for user_id in user_ids])
+
+
+def notify_users(user_ids, event_type, payload):
+    """
+    Build the frame once and push it to every given user.
+    """
+    if user_ids:
+        async_to_sync(send_to_users)(get_channel_layer(), user_ids, frame_event(event_type, payload))
+
+
+def notify_outbid(listing, user_id, price):
+    """
+    Tell user that his leading bid on the listing was beaten, after the new bid is committed.
+    """
+    payload = {'notification': 'outbid', 'listing_id': listing.id, 'listing_name': listing.name,
+               'price': f"{price:.2f}"}
+    transaction.on_commit(lambda: notify_users([user_id], 'notification', payload))
+
+
+def watcher_id_chunks(listing_id, chunk_size):
+    """
+    Yield lists of ids of users watching the listing, every chunk is one keyset read of the watchlist table.
+    """
+    watchers = User.watchlist.through.objects.filter(auctionlisting_id=listing_id).order_by('id')
+    last_id = 0
+    while True:
+        chunk = list(watchers.filter(id__gt=last_id).values_list('id', 'user_id')[:chunk_size])
+        if not chunk:
+            return
+        yield [user_id for _, user_id in chunk]
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1][0]
+
+
+def notify_watchers(listing, event_type, payload, chunk_size=None):
+    """
+    Push notification to every watcher of the listing chunk by chunk. Returns number of notified users.
+    """
+    chunk_size = chunk_size or settings.WATCHERS_NOTIFY_CHUNK_SIZE
+    notified = 0
+    for user_ids in watcher_id_chunks(listing.id, chunk_size):
+        notify_users(user_ids, event_type, payload)
+        notified += len(user_ids)
+    return notified
+
+
+def claim_ending_listing(listing_id):
+    """
+    Mark listing as notified about its end by conditional UPDATE, only one worker gets True.
+    """
+    return bool(AuctionListing.objects.filter(pk=listing_id, active=True, ending_notified=False).update(
+        ending_notified=True
+    ))
@@ -0,0 +1,63 @@
+import base64
+import binascii
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+
+def encode_cursor(*values):
+    """
+    Encode position of the last item on a page to opaque url-safe string.
+    """
+    return base64.urlsafe_b64encode(json.dumps([str(value) for value in values]).encode()).decode()
+
+
+def decode_cursor(cursor, fields):
+    """
+    Decode cursor made by encode_cursor to list of values of model "fields", each converted and validated
+    by its field. Raise ValueError if cursor is broken.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    if not (isinstance(values, list) and len(values) == len(fields)
+            and all(isinstance(value, str) for value in values)):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    try:
+        values = [field.to_python(value) for field, value in zip(fields, values)]
+        for field, value in zip(fields, values):
+            # Validators reject values the database can't compare, e.g. NaN prices or ids out of integer range
+            field.run_validators(value)
+    except ValidationError:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return values
+
+
+def keyset_q(fields, values, descending=False):
+    """
+    Return Q for rows which go after "values" in (fields) order, e.g. for two fields:
+    (a > x) OR (a = x AND b > y)
+    """
+    lookup = "lt" if descending else "gt"
+    q = Q()
+    for i in reversed(range(len(fields))):
+        after = Q(**{f"{fields[i]}__{lookup}": values[i]})
+        q = after if not q else after | (Q(**{fields[i]: values[i]}) & q)
+    return q
+
+
+def keyset_page(queryset, fields, cursor=None, page_size=50, descending=False):
+    """
+    Return (items, has_next) of the page which goes after "cursor" in queryset ordered by "fields",
+    which are model fields or annotations of the queryset. Raise ValueError if cursor is broken.
+    """
+    queryset = queryset.order_by(*[f"-{field}" if descending else field for field in fields])
+    if cursor:
+        annotations = queryset.query.annotations
+        model_fields = [annotations[field].output_field if field in annotations
+                        else queryset.model._meta.get_field(field) for field in fields]
+        queryset = queryset.filter(keyset_q(fields, decode_cursor(cursor, model_fields), descending))
+    items = list(queryset[:page_size + 1])
+    return items[:page_size], len(items) > page_size
@@ -1,6 +1,6 @@
 from rest_framework import serializers
 
-from .models import Bid
+from .models import Bid, Comment
 
 
 class BidUserSerializer(serializers.Serializer):
@@ -14,3 +14,16 @@ class BidSerializer(serializers.ModelSerializer):
     class Meta:
         model = Bid
         fields = ['date', 'user', 'value']
+
+
+class CommentUserSerializer(serializers.Serializer):
+    username = serializers.CharField(source='user.username', max_length=200)
+    avatar = serializers.ImageField(source='user.avatar', use_url=True)
+
+
+class CommentSerializer(serializers.ModelSerializer):
+    user = CommentUserSerializer(source="*")
+
+    class Meta:
+        model = Comment
+        fields = ['id', 'date', 'user', 'text']
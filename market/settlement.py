@@ -0,0 +1,101 @@
+from collections import Counter
+from itertools import permutations
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.urls import reverse
+from django.utils import timezone
+
+from .events import listing_event
+from .models import (AuctionListing, Chat, Message, User, add_unread_messages, bump_listing_version,
+                     invalidate_nav_badges)
+
+
+def winner_message_text(listing_id):
+    return f"Hi, you won my listing at link {reverse('market:details', kwargs={'listing_id': listing_id})}"
+
+
+def get_or_create_chats(pairs):
+    """
+    Return dict {(user_id, other_user_id): chat_id} for every given pair of users.
+    Existing chats are found with one query, missing chats are created.
+    """
+    wanted = set(pairs)
+    user_ids = {user_id for pair in wanted for user_id in pair}
+    members = {}
+    memberships = Chat.members.through.objects.filter(user_id__in=user_ids).values_list('chat_id', 'user_id')
+    for chat_id, user_id in memberships:
+        members.setdefault(chat_id, set()).add(user_id)
+
+    chats = {}
+    for chat_id in sorted(members):
+        for pair in permutations(members[chat_id], 2):
+            if pair in wanted:
+                chats.setdefault(pair, chat_id)
+
+    new_members = []
+    for pair in wanted:
+        if pair not in chats:
+            chat = Chat.objects.create()
+            chats[pair] = chats[pair[::-1]] = chat.id
+            new_members += [Chat.members.through(chat_id=chat.id, user_id=user_id) for user_id in pair]
+    Chat.members.through.objects.bulk_create(new_members)
+    return chats
+
+
+def settle_listings(listings, skip_locked=True):
+    """
+    Close given queryset of listings and reward winners in one transaction.
+
+    Settlement is keyed on the listing: only active listings are settled, rows locked by
+    another transaction are skipped, so duplicate deliveries are no-op. With skip_locked=False
+    locked rows are waited for instead and settled if they are still active then.
+    Win-list rows and winner messages are inserted in bulk.
+    Returns list of settled listings.
+    """
+    with transaction.atomic():
+        settled = list(
+            listings.filter(active=True)
+            .select_for_update(skip_locked=skip_locked, of=('self',))
+            .select_related('leading_bid')
+        )
+        if not settled:
+            return []
+        AuctionListing.objects.filter(id__in=[listing.id for listing in settled]).update(active=False)
+        for listing in settled:
+            listing.active = False
+            # Cached bid box of the page still shows the listing as active
+            bump_listing_version(listing.id)
+
+        won = [listing for listing in settled if listing.leading_bid_id]
+        chats = get_or_create_chats([(listing.leading_bid.user_id, listing.user_id) for listing in won])
+        User.winlist.through.objects.bulk_create([
+            User.winlist.through(user_id=listing.leading_bid.user_id, auctionlisting_id=listing.id)
+            for listing in won
+        ], ignore_conflicts=True)
+        date = timezone.now()
+        Message.objects.bulk_create([
+            Message(
+                chat_id=chats[(listing.leading_bid.user_id, listing.user_id)],
+                sender_id=listing.user_id,
+                receiver_id=listing.leading_bid.user_id,
+                text=winner_message_text(listing.id),
+                date=date,
+            )
+            for listing in won
+        ])
+        winner_messages = Counter(listing.leading_bid.user_id for listing in won)
+        add_unread_messages(winner_messages)
+        invalidate_nav_badges(*winner_messages)
+
+    channel_layer = get_channel_layer()
+    for listing in settled:
+        win_user_id = listing.leading_bid.user_id if listing.leading_bid_id else listing.user_id
+        async_to_sync(channel_layer.group_send)(
+            "market_%s" % listing.id,
+            listing_event(listing.id, 'listing_winner', {
+                'win_user_id': f"{win_user_id}",
+            })
+        )
+    return settled
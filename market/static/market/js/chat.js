@@ -7,6 +7,8 @@ if (scroll_check) {
 }
 
 const chatId = document.getElementById("chat-id").value
+const userName = document.getElementById("chat-user-name").value
+const userAvatar = document.getElementById("chat-user-avatar").value
 
 chatSocket.onmessage = function (e) {
   /**
@@ -26,11 +28,11 @@ chatSocket.onmessage = function (e) {
                 <i>${data['message_date']}</i>
               </div>
               <div class="chat-avatar">
-                <img src="${data['user']['avatar']['url']}" class="rounded" alt=""/>
+                <img src="${userAvatar}" class="rounded" alt=""/>
               </div>
               <div class="conversation-text">
                 <div class="ctext-wrap">
-                  <i>${data['sender']}</i>
+                  <i>${userName}</i>
                   <p>${data['message']}</p>
                 </div>
               </div>
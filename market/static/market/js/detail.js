@@ -3,7 +3,28 @@
 
 const lastBid = document.getElementById("listing-last-bid")
 const listing_id = document.getElementById("auction-listing-id").value;
-const listingSocket = new WebSocket(`ws://${window.location.host}/ws/market/${listing_id}/`);
+
+// Sequence number up to which every listing event is applied to the page,
+// reconnecting socket resumes from it and server replays only missed events
+let listingSeq = Number(document.getElementById("listing-seq").value)
+// Applied events above listingSeq, live events may overtake each other and replayed ones
+const appliedSeqs = new Set()
+// Sequence number of the newest applied bid, older bid delivered late doesn't replace it
+let bidSeq = listingSeq
+let listingSocket = connectListingSocket()
+
+function connectListingSocket() {
+	const socket = new WebSocket(`ws://${window.location.host}/ws/market/${listing_id}/?resume_from=${listingSeq}`);
+	socket.onmessage = onListingMessage;
+	socket.onclose = (e) => {
+		console.error("Listing details page connection was interrupted, reconnecting");
+		// Random delay spreads reconnects of all watchers after server restart
+		setTimeout(() => {
+			listingSocket = connectListingSocket()
+		}, 1000 + Math.random() * 4000);
+	};
+	return socket
+}
 
 const listingEndDate = document.getElementById("listing-end-date").value
 const countDownDate = new Date(listingEndDate).getTime()
@@ -36,72 +57,73 @@ if (diff <= 0) {
 	document.getElementById("countdown-box").innerHTML = "EXPIRED";
 }
 
+// Position of the last bid shown in history, next requests fetch only newer bids
+let bidHistoryCursor = ""
+
 function bidhistory() {
 
 	/**
-	 * Function that loads listing's bids info by REST API using AJAX
+	 * Function that loads listing's bids info by REST API using AJAX.
+	 * Bids are loaded page by page after the last shown bid,
+	 * unchanged history is answered with 304 and nothing is redrawn.
 	 */
 
 	const is_open = document.getElementById("is_open").value;
 	const listing_id = document.getElementById("auction-listing-id").value;
 
 	if (is_open === "1"){
-		const historyList = []
-
-		$.ajax({
-			type:"GET", url:"/market/api/"+listing_id+"/all_bids", success: (result) => {
-				for (const bid_item in result){
-					const username = result[bid_item].user.username;
-					const bid_date = new Date(result[bid_item].date);
-                    const value = result[bid_item].value;
-
-					historyList.push(
-						`
+		const historyListTable = document.getElementById("history-list");
+		historyListTable.style.display = "";
+
+		const historyBtn = document.getElementById("history-btn");
+		historyBtn.innerHTML = "Hide";
+		historyBtn.onclick = () => clearhistory();
+
+		// Add main HTML element for bids history list if no elements exists
+		if (document.getElementById("history-row") === null) {
+			historyListTable.innerHTML = `
+				<table class="table table-bordered table-centered mb-0">
+					<h4 class="mt-0 text-primary">History</h4>
+					<thead class="thead-light">
 						<tr>
-							<td class="previous-result">&#64;${username}</td>
-							<td class="previous-result">${value}</td>
-							<td class="previous-result">${bid_date}</td>
+							<th>User</th>
+							<th>Last Bid</th>
+							<th>Date</th>
 						</tr>
-						`
-					)
-				}
-
-				// Previous result is what placed on client's page
-				const previous_result = document.getElementsByClassName("previous-result");
-				const previous_result_length = previous_result.length;
-				const historyList_length = historyList.length;
-
-				// Add main HTML element for bids history list if no elements exists
-				if (previous_result.length === 0) {
-					const historyListTable = document.getElementById("history-list");
-					historyListTable.innerHTML = `
-						<table class="table table-bordered table-centered mb-0">
-							<h4 class="mt-0 text-primary">History</h4>
-							<thead class="thead-light">
-								<tr>
-									<th>User</th>
-									<th>Last Bid</th>
-									<th>Date</th>
-								</tr>
-							</thead>
-							<tbody id="history-row">
-							</tbody>
-						</table>
-					`
-				}
+					</thead>
+					<tbody id="history-row">
+					</tbody>
+				</table>
+			`
+		}
 
-				if (historyList_length !== previous_result_length) {
-					// Add element differences to the page
-                    for (let i = previous_result_length; i < historyList_length; i++) {
-						document.getElementById("history-row").innerHTML += historyList[i];
+		$.ajax({
+			type:"GET", url:`/market/api/${listing_id}/all_bids?cursor=${bidHistoryCursor}`, ifModified: true,
+			success: (result) => {
+				if (result) {
+					for (const bid_item of result.results){
+						const username = bid_item.user.username;
+						const bid_date = new Date(bid_item.date);
+						const value = bid_item.value;
+
+						document.getElementById("history-row").innerHTML +=
+							`
+							<tr>
+								<td class="previous-result">&#64;${username}</td>
+								<td class="previous-result">${value}</td>
+								<td class="previous-result">${bid_date}</td>
+							</tr>
+							`
 					}
+					bidHistoryCursor = result.cursor || "";
 
-					const historyBtn = document.getElementById("history-btn");
-					historyBtn.innerHTML = "Hide";
-					historyBtn.onclick = () => clearhistory();
+					// Load the rest of history right away
+					if (result.next) {
+						bidhistory();
+						return;
+					}
 				}
 
-				// If length of New result and previous same - just wait for next AJAX
 				if ((document.getElementById("autoupdate").checked)) {
 					setTimeout(() => {
 						bidhistory()
@@ -118,7 +140,7 @@ function clearhistory() {
 	historyBtn.onclick = () => turn_is_open()
 
 	document.getElementById("is_open").setAttribute("value", "0");
-	document.getElementById("history-list").innerHTML = "";
+	document.getElementById("history-list").style.display = "none";
 }
 
 function turn_is_open(){
@@ -151,19 +173,6 @@ $(function(){
 		const endlisting = 'end';
 		listingSocket.send(JSON.stringify({ 'endlisting':endlisting, 'listing_id':listing_id, }));
 	});
-
-	listingSocket.onopen = (e) => {
-		$.ajax({type:"GET", url:`/market/api/${listing_id}/last_bid`,
-			success:(result) => {
-				if (result.value) {
-				lastBid.value = result.value
-				} else {
-					const lastBidInfo = JSON.parse(result.data)
-					lastBid.value = lastBidInfo.value
-				}
-			}
-		});
-	};
 });
 
 function makeBid() {
@@ -261,30 +270,37 @@ function makeComment() {
 	}
 }
 
-listingSocket.onmessage = (e) => {
+function onListingMessage(e) {
 	const data = JSON.parse(e.data);
 
-	if (data["new_bid_set"]) {
+	if (data["resync"]) {
+		// Missed events already left server's buffer, random delay spreads reloads of all watchers
+		setTimeout(() => window.location.reload(), Math.random() * 3000);
+		return;
+	}
+
+	if (data["seq"]) {
+		// Skip only events which were already applied, replayed and then delivered live again
+		if (data["seq"] <= listingSeq || appliedSeqs.has(data["seq"])) {
+			return;
+		}
+		appliedSeqs.add(data["seq"]);
+		while (appliedSeqs.delete(listingSeq + 1)) {
+			listingSeq += 1;
+		}
+	}
+
+	if (data["new_bid_set"] && !(data["seq"] < bidSeq)) {
 		lastBid.value = data["new_bid_set"];
+		bidSeq = data["seq"] || bidSeq;
 	}
 
-	if (data["comment"]) {
+	// Page may already render the comment which is replayed after it, as its seq was read before comments
+	if (data["comment"] && !document.querySelector(`[data-comment-id="${Number(data["comment_id"])}"]`)) {
 		const commentBox = document.getElementById("comment-box");
 
-		const newComment = document.createElement("div")
-		newComment.innerHTML +=`
-			<div class="media mt-2">
-				<img class="mr-3 avatar-sm rounded-circle" alt=""
-					 src="${data['avatar']}"/>
-				<div class="media-body">
-					<h5 class="mt-0">
-						&#64;${data['username']}
-						<i>${data['comment_date']}</i>
-					</h5>
-					<p class>${data['comment']}</p>
-				</div>
-			</div>
-		`
+		const newComment = commentElement(data["comment_id"], data["avatar"], data["username"],
+			data["comment_date"], data["comment"])
 		commentBox.appendChild(newComment);
 		document.getElementById('comment-input').value = "";
 
@@ -297,8 +313,82 @@ listingSocket.onmessage = (e) => {
 			}
 		}
 	}
-};
+}
+
+const DEFAULT_AVATAR_URL = "https://external-content.duckduckgo.com/iu/?u=http%3A%2F%2Fwww.pngall.com%2Fwp-content%2Fuploads%2F5%2FProfile-PNG-Image-180x180.png"
+
+function commentElement(id, avatar, username, date, text) {
+	/**
+	 * Build comment like the ones rendered by the template.
+	 * Username and text are written by users, so they are added as text, never as HTML.
+	 */
+	const image = document.createElement("img");
+	image.className = "mr-3 avatar-sm rounded-circle";
+	image.alt = "";
+	image.src = avatar || DEFAULT_AVATAR_URL;
+
+	const dateElement = document.createElement("i");
+	dateElement.textContent = date;
+	const title = document.createElement("h5");
+	title.className = "mt-0";
+	title.append(`@${username} `, dateElement);
+
+	const textElement = document.createElement("p");
+	textElement.textContent = text;
+
+	const body = document.createElement("div");
+	body.className = "media-body";
+	body.append(title, textElement);
+
+	const comment = document.createElement("div");
+	comment.className = "media mt-2";
+	comment.dataset.commentId = id;
+	comment.append(image, body);
+	return comment;
+}
+
+function loadOlderComments() {
+	/**
+	 * Load page of comments older than the oldest shown one and add them above it.
+	 * Button is removed when there are no older comments.
+	 */
+
+	const oldestComment = document.getElementById("oldest-comment-id")
+
+	$.ajax({
+		type:"GET", url:`/market/api/${listing_id}/comments?before=${oldestComment.value}`,
+		success: (result) => {
+			// Page goes from newer to older comments, each one is added above the previous
+			const olderComments = document.getElementById("older-comments");
+			for (const comment of result.results) {
+				olderComments.prepend(commentElement(comment.id, comment.user.avatar, comment.user.username,
+					new Date(comment.date).toLocaleString(), comment.text));
+			}
+
+			if (result.next) {
+				oldestComment.value = result.next;
+			} else {
+				document.getElementById("older-comments-button").remove();
+			}
+		}
+	});
+}
 
-listingSocket.onclose = (e) => {
-	console.error("Listing details page connection was interrupted");
-};
\ No newline at end of file
+const watchlistForm = document.getElementById("watchlist-form")
+
+if (watchlistForm) {
+	watchlistForm.onsubmit = (e) => {
+		/**
+		 * Toggle listing in watchlist without reloading the page, server answers with the new state.
+		 */
+		e.preventDefault()
+		$.ajax({
+			type:"POST", url:watchlistForm.action,
+			data: $(watchlistForm).serialize() + "&format=json",
+			success: (result) => {
+				document.getElementById("add-listing-to-watchlist").value =
+					result.watched ? "Remove from watchlist" : "Add to Watchlist";
+			}
+		});
+	}
+}
@@ -0,0 +1,102 @@
+// Infinite scroll of listings grid: when "Next page" link becomes visible,
+// the next page is loaded as JSON and its cards are added to the grid.
+
+const nextPage = document.getElementById("next-page")
+const listingsGrid = document.getElementById("listings-grid")
+let isLoading = false
+
+function listingCard(listing) {
+	/**
+	 * Build card of listing the same as listing's card rendered by index.html.
+	 * Name and image are written by the seller, so they are set as text and attribute, never as HTML.
+	 */
+
+	const card = document.createElement("div")
+	card.className = "col-md-6 col-lg-4"
+	card.innerHTML = `
+		<div class="card">
+			<div class="col-lg-5 text-center d-block mb-4">
+				<img class="img-fluid" alt="2" style="max-width: 300px; max-height: 300px;">
+			</div>
+			<div class="card-body">
+				<h5 class="card-title">
+					<a class="text-success stretched-link"></a>
+				</h5>
+				<p class="card-text">
+					<span class="text-dark">Price: </span>
+					<strong class="listing-price"></strong>
+				</p>
+				<p class="card-text listing-my-bid">
+					<span class="text-dark">My Bid: </span>
+					<strong class="listing-my-max-bid"></strong>
+					${listing.is_leading
+						? '<span class="badge badge-success-lighten">Leading</span>'
+						: '<span class="badge badge-warning-lighten">Outbid</span>'}
+				</p>
+				<p class="card-text">
+					<span class="text-dark">Created: </span>
+					<strong class="listing-created"></strong>
+				</p>
+				<p class="card-text">
+					<span class="text-dark">Estimation date: </span>
+					<strong class="listing-end"></strong>
+				</p>
+				<p>
+					${listing.active
+						? '<span class="badge badge-success-lighten">Active</span>'
+						: '<span class="badge badge-danger-lighten">Ended</span>'}
+					${listing.watched
+						? '<span class="badge badge-primary-lighten">Watching</span>'
+						: '<span class="badge badge-primary-lighten">Not Watching</span>'}
+				</p>
+			</div>
+		</div>
+	`
+	card.querySelector("img").src = listing.image
+	const link = card.querySelector("a")
+	link.href = `/market/${Number(listing.id)}/`
+	link.textContent = listing.name
+	card.querySelector(".listing-price").textContent = `$${listing.price}`
+	if (listing.my_max_bid === undefined) {
+		card.querySelector(".listing-my-bid").remove()
+	} else {
+		card.querySelector(".listing-my-max-bid").textContent = `$${listing.my_max_bid}`
+	}
+	card.querySelector(".listing-created").textContent = new Date(listing.creationDate).toLocaleString()
+	card.querySelector(".listing-end").textContent = new Date(listing.endDate).toLocaleString()
+	return card
+}
+
+function loadNextPage() {
+	if (isLoading) {
+		return
+	}
+	isLoading = true
+
+	const url = new URL(nextPage.href)
+	url.searchParams.set("format", "json")
+
+	$.ajax({
+		type:"GET", url:url.toString(),
+		success: (result) => {
+			listingsGrid.append(...result.results.map(listingCard))
+
+			if (result.next) {
+				url.searchParams.set("cursor", result.next)
+				url.searchParams.delete("format")
+				nextPage.href = url.toString()
+			} else {
+				nextPage.remove()
+				observer.disconnect()
+			}
+			isLoading = false
+		}
+	});
+}
+
+const observer = new IntersectionObserver((entries) => {
+	if (entries.some((entry) => entry.isIntersecting)) {
+		loadNextPage()
+	}
+});
+observer.observe(nextPage)
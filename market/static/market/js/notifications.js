@@ -0,0 +1,36 @@
+// Personal notifications of the user: outbid bids and watched listings ending soon
+
+const notificationsBox = document.getElementById("notifications")
+
+function connectNotificationSocket() {
+	const socket = new WebSocket(`ws://${window.location.host}/ws/market/notifications/`);
+	socket.onmessage = (e) => {
+		const data = JSON.parse(e.data);
+		// Listing name is written by the seller, so it is added as text, never as HTML
+		const link = document.createElement("a");
+		link.href = `/market/${Number(data['listing_id'])}`;
+		link.textContent = data['listing_name'];
+
+		const notification = document.createElement("div");
+		notification.className = "alert alert-info alert-dismissible mt-2";
+		notification.setAttribute("role", "alert");
+		notification.innerHTML = `
+			<button type="button" class="close" data-dismiss="alert" aria-label="Close">
+				<span aria-hidden="true">&times;</span>
+			</button>
+		`;
+		if (data['notification'] === "outbid") {
+			notification.append("You were outbid on ", link, `, current price is ${data['price']}`);
+		} else if (data['notification'] === "ending_soon") {
+			notification.append("Watched listing ", link, ` ends at ${new Date(data['end_date']).toLocaleString()}`);
+		}
+		notificationsBox.appendChild(notification);
+	};
+	socket.onclose = (e) => {
+		// Random delay spreads reconnects of all users after server restart
+		setTimeout(connectNotificationSocket, 1000 + Math.random() * 4000);
+	};
+	return socket
+}
+
+connectNotificationSocket()
@@ -1,50 +1,68 @@
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-from django.urls import reverse
+import datetime
+
+from django.conf import settings
+from django.utils import timezone
 
 from auctsite.celery import app
-from .models import *
+from .models import AuctionListing
+from .notifications import claim_ending_listing, notify_watchers
+from .settlement import settle_listings
+
+
+@app.task
+def close_expired_listings(batch_size=None):
+    """
+    Settle every active listing whose end date has passed, batch by batch.
+    Runs periodically by celery beat (see CELERY_BEAT_SCHEDULE in settings).
+    """
+    batch_size = batch_size or settings.AUCTION_CLOSER_BATCH_SIZE
+    closed = 0
+    while True:
+        expired = AuctionListing.objects.filter(active=True, endDate__lte=timezone.now()).order_by('endDate')
+        batch_closed = len(settle_listings(AuctionListing.objects.filter(id__in=list(
+            expired.values_list('id', flat=True)[:batch_size]
+        ))))
+        closed += batch_closed
+        if batch_closed < batch_size:
+            return closed
+
+
+@app.task
+def settle_listing(listing_id):
+    """
+    Settle one listing right now, used when owner ends the listing before its end date.
+    Row locked by a bid is waited for, skipped listing wouldn't be retried until close_expired_listings.
+    """
+    return bool(settle_listings(AuctionListing.objects.filter(id=listing_id), skip_locked=False))
+
+
+@app.task
+def notify_ending_soon(batch_size=None):
+    """
+    Tell watchers of every active listing ending within ENDING_SOON_WINDOW that it ends soon.
+    Runs periodically by celery beat, every listing is claimed by ending_notified flag, so it is notified once.
+    Returns number of notified listings.
+    """
+    batch_size = batch_size or settings.AUCTION_CLOSER_BATCH_SIZE
+    ending_before = timezone.now() + datetime.timedelta(seconds=settings.ENDING_SOON_WINDOW)
+    listings = AuctionListing.objects.filter(
+        active=True, ending_notified=False, endDate__lte=ending_before
+    ).order_by('endDate').only('id', 'name', 'endDate')
+    notified = 0
+    for listing in listings[:batch_size]:
+        if not claim_ending_listing(listing.id):
+            continue
+        notify_watchers(listing, 'notification', {
+            'notification': 'ending_soon',
+            'listing_id': listing.id,
+            'listing_name': listing.name,
+            'end_date': listing.endDate.isoformat(),
+        })
+        notified += 1
+    return notified
 
 
 @app.task
 def create_task(listing_id):
-    channel_layer = get_channel_layer()
-    try:
-        listing = AuctionListing.objects.get(id=listing_id)
-    except AuctionListing.DoesNotExist:
-        return False
-    listing.active = False
-    listing.save()
-    # Define winner
-    bids = Bid.objects.filter(listing=listing)
-    if not bids:
-        async_to_sync(channel_layer.group_send)(
-            "market_%s" % listing.id,
-            {
-                'type': 'listing_winner',
-                'win_user_id': f"{listing.user.id}"
-            }
-        )
-    else:
-        last_bid = bids.order_by('-value')[0]
-        win_user = last_bid.user
-        win_user.winlist.add(listing)
-        win_user.save()
-        new_message_text = f"Hi, you won my listing at link {reverse('market:details', kwargs={'listing_id': listing.id})}"
-        try:
-            chat = Chat.objects.filter(members=win_user).get(members=listing.user)
-        except Chat.DoesNotExist:
-            chat = Chat.objects.create()
-            chat.members.add(win_user, listing.user)
-
-        new_message = Message.objects.create(chat=chat, sender_id=listing.user.id, text=new_message_text)
-
-        async_to_sync(channel_layer.group_send)(
-            "market_%s" % listing.id,
-            {
-                'type': 'listing_winner',
-                'win_user_id': f"{win_user.id}"
-            }
-        )
-
-        return True
+    # Kept for countdown tasks that were scheduled before close_expired_listings existed
+    return settle_listing(listing_id)
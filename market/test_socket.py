@@ -1,4 +1,9 @@
+import asyncio
 import datetime
+import json
+import os
+import time
+from unittest import mock
 
 import pytest
 from channels.auth import AuthMiddlewareStack
@@ -6,12 +11,19 @@ from channels.db import database_sync_to_async
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.testing import WebsocketCommunicator
 from django.core.asgi import get_asgi_application
+from django.core.cache import cache
+from django.db import connection
 from django.test import Client
+from django.test.utils import CaptureQueriesContext
 from django.urls import re_path
 from django.urls import reverse
 
-from .consumers import ListingConsumer, ChatConsumer
+from . import frames
+from .bidding import place_bid
+from .consumers import ListingConsumer, ChatConsumer, NotificationConsumer
+from .frames import frame_event
 from .models import *
+from .tasks import notify_ending_soon
 
 
 @database_sync_to_async
@@ -2137,6 +2149,87 @@ async def test_listing_decimal_value_new_bid_placement_anonymous():
 #    await communicator.disconnect()
 #    await clear_all_bd()
 #
+"""
+END LISTING ACTIVE LISTING - SETTLEMENT IS HANDED OFF TO CELERY
+"""
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_end_listing_owner_enqueues_settlement():
+    """
+    If listing's owner ends active listing, settlement task is enqueued and consumer doesn't settle listing itself
+    """
+    client = Client()
+    user = await async_create_user(username="test_user", password="test_password")
+    client_login = await async_login_client(client, "test_user", "test_password")
+    category = await async_create_category(name="test_category")
+    listing = await async_create_listing(name="test_listing", image="None", description="test_desc", category=category,
+                                         user=user, startBid=100, days=30, active=True)
+    headers = [(b'origin', b'...'), (b'cookie', client_login.cookies.output(header='', sep='; ').encode())]
+    application = ProtocolTypeRouter({
+        "http": get_asgi_application(),
+
+        "websocket": AuthMiddlewareStack(
+            URLRouter([
+                re_path(r"^ws/market/(?P<listing_id>\w+)/$", ListingConsumer.as_asgi()),
+            ])
+        ),
+    })
+    communicator = WebsocketCommunicator(application,
+                                         "ws" + reverse("market:details", kwargs={"listing_id": listing.id}), headers)
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    with mock.patch("market.consumers.settle_listing.delay") as settle_delay:
+        await communicator.send_json_to({"endlisting": "end", "listing_id": listing.id})
+        assert await communicator.receive_nothing()
+    settle_delay.assert_called_once_with(listing.id)
+    ended = await database_sync_to_async(AuctionListing.objects.get)(pk=listing.id)
+    assert ended.active
+    # Listing already counts as ended, so the periodic closer settles it even if the task is lost
+    assert ended.endDate <= timezone.now()
+    await communicator.disconnect()
+    await clear_all_bd(client_login)
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_end_listing_not_owner():
+    """
+    If logged in user who is not listing's owner tries to end the listing, return Error from websocket
+    """
+    client = Client()
+    user = await async_create_user(username="test_user", password="test_password")
+    user_2 = await async_create_user(username="test_user_2", password="test_password")
+    client_login = await async_login_client(client, "test_user_2", "test_password")
+    category = await async_create_category(name="test_category")
+    listing = await async_create_listing(name="test_listing", image="None", description="test_desc", category=category,
+                                         user=user, startBid=100, days=30, active=True)
+    headers = [(b'origin', b'...'), (b'cookie', client_login.cookies.output(header='', sep='; ').encode())]
+    application = ProtocolTypeRouter({
+        "http": get_asgi_application(),
+
+        "websocket": AuthMiddlewareStack(
+            URLRouter([
+                re_path(r"^ws/market/(?P<listing_id>\w+)/$", ListingConsumer.as_asgi()),
+            ])
+        ),
+    })
+    communicator = WebsocketCommunicator(application,
+                                         "ws" + reverse("market:details", kwargs={"listing_id": listing.id}), headers)
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    with mock.patch("market.consumers.settle_listing.delay") as settle_delay:
+        await communicator.send_json_to({"endlisting": "end", "listing_id": listing.id})
+        response = await communicator.receive_json_from()
+    assert response == {
+        'error-socket': "Only listing's owner can end the listing",
+    }
+    settle_delay.assert_not_called()
+    await communicator.disconnect()
+    await clear_all_bd(client_login)
+
+
 # Post new comment on Listing page
 """
 POST NEW COMMENT ACTIVE LISTING - LOGGED USER
@@ -3876,3 +3969,511 @@ async def test_connect_to_chat_websocket_anonymous():
     communicator = WebsocketCommunicator(application, "ws" + reverse("market:inbox"))
     connected, subprotocol = await communicator.connect()
     assert not connected
+
+
+"""
+LISTING CONSUMER - MANY WATCHERS
+"""
+
+
+async def connect_listing_watchers(application, listing, count):
+    communicators = [
+        WebsocketCommunicator(application, "ws" + reverse("market:details", kwargs={"listing_id": listing.id}))
+        for _ in range(count)
+    ]
+    results = await asyncio.gather(*[communicator.connect() for communicator in communicators])
+    assert all(connected for connected, subprotocol in results)
+    return communicators
+
+
+@pytest.mark.skipif(not os.environ.get("RUN_BENCHMARKS"), reason="Wall clock benchmark, set RUN_BENCHMARKS=1 to run it")
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_listing_new_bid_placement_many_watchers():
+    """
+    Async ListingConsumer doesn't hold a thread per socket, so hundreds of watchers connect to one listing
+    without exhausting sync executor and every watcher receives new bid
+    """
+    client = Client()
+    user = await async_create_user(username="watchers_owner", password="test_password")
+    user_2 = await async_create_user(username="watchers_bidder", password="test_password")
+    client_login = await async_login_client(client, "watchers_bidder", "test_password")
+    category = await async_create_category(name="test_category")
+    listing = await async_create_listing(name="test_listing", image="None", description="test_desc", category=category,
+                                         user=user, startBid=100, days=30, active=True)
+    headers = [(b'origin', b'...'), (b'cookie', client_login.cookies.output(header='', sep='; ').encode())]
+    application = ProtocolTypeRouter({
+        "http": get_asgi_application(),
+
+        "websocket": AuthMiddlewareStack(
+            URLRouter([
+                re_path(r"^ws/market/(?P<listing_id>\w+)/$", ListingConsumer.as_asgi()),
+            ])
+        ),
+    })
+    for watchers_count in (50, 500):
+        start = time.perf_counter()
+        watchers = await connect_listing_watchers(application, listing, watchers_count)
+        connect_time = time.perf_counter() - start
+        bidder = WebsocketCommunicator(application,
+                                       "ws" + reverse("market:details", kwargs={"listing_id": listing.id}), headers)
+        connected, subprotocol = await bidder.connect()
+        assert connected
+        await bidder.send_json_to({"newbid": f"{200 + watchers_count}", "listing_id": listing.id})
+        responses = await asyncio.gather(*[watcher.receive_json_from() for watcher in watchers + [bidder]])
+        assert responses == [{'new_bid_set': f"{200.0 + watchers_count}"}] * (watchers_count + 1)
+        print(f"{watchers_count} watchers: connected in {connect_time:.3f}s, "
+              f"{connect_time / watchers_count * 1000:.3f}ms per connection")
+        await asyncio.gather(*[watcher.disconnect() for watcher in watchers + [bidder]])
+    await clear_all_bd(client_login)
+
+
+"""
+CHAT CONSUMER - GROWING CHAT HISTORY
+"""
+
+
+@database_sync_to_async
+def async_create_chat_history(chat, sender, receiver, count):
+    Message.objects.bulk_create([
+        Message(chat=chat, sender=sender, receiver=receiver, text=f"message {i}", date=timezone.now())
+        for i in range(count)
+    ])
+
+
+@database_sync_to_async
+def start_capture_queries():
+    # Consumer's db calls run in the same thread as database_sync_to_async helpers of the test
+    context = CaptureQueriesContext(connection)
+    context.__enter__()
+    return context
+
+
+@database_sync_to_async
+def stop_capture_queries(context):
+    context.__exit__(None, None, None)
+    return len(context)
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_send_message_constant_cost_growing_history():
+    """
+    Sending a message costs the same number of queries whether chat has 10 or 500 earlier messages
+    """
+    client_sender = Client()
+    sender = await async_create_user(username="history_sender", password="test_password")
+    receiver = await async_create_user(username="history_receiver", password="test_password")
+    chat = await async_create_chat_object(sender, receiver)
+    sender_login = await async_login_client(client_sender, "history_sender", "test_password")
+    headers_sender = [(b'origin', b'...'), (b'cookie', sender_login.cookies.output(header='', sep='; ').encode())]
+    application = ProtocolTypeRouter({
+        "http": get_asgi_application(),
+
+        "websocket": AuthMiddlewareStack(
+            URLRouter([
+                re_path(r"^ws/market/inbox/$", ChatConsumer.as_asgi()),
+            ])
+        ),
+    })
+    communicator = WebsocketCommunicator(application, "ws" + reverse("market:inbox"), headers_sender)
+    connected, subprotocol = await communicator.connect()
+    assert connected
+
+    queries = []
+    for history in (10, 490):
+        await async_create_chat_history(chat, receiver, sender, history)
+        context = await start_capture_queries()
+        await communicator.send_json_to({"new_message_text": "Hello World!", "chat_id": chat.id})
+        response = await communicator.receive_json_from()
+        queries.append(await stop_capture_queries(context))
+        assert response['send_self'] == 'yes'
+    assert queries[0] == queries[1]
+
+    await communicator.disconnect()
+    await clear_all_bd(sender_login)
+
+
+"""
+LISTING CONSUMER - COMMENT FAN-OUT
+"""
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_listing_post_new_comment_fan_out_without_queries():
+    """
+    Commenter's display data is resolved once at connection, so broadcasting comment to watchers costs
+    no queries and no avatar url computations
+    """
+    client = Client()
+    user = await async_create_user(username="fan_out_owner", password="test_password")
+    user_2 = await async_create_user(username="fan_out_commenter", password="test_password")
+    client_login = await async_login_client(client, "fan_out_commenter", "test_password")
+    category = await async_create_category(name="test_category")
+    listing = await async_create_listing(name="test_listing", image="None", description="test_desc", category=category,
+                                         user=user, startBid=100, days=30, active=True)
+    headers = [(b'origin', b'...'), (b'cookie', client_login.cookies.output(header='', sep='; ').encode())]
+    application = ProtocolTypeRouter({
+        "http": get_asgi_application(),
+
+        "websocket": AuthMiddlewareStack(
+            URLRouter([
+                re_path(r"^ws/market/(?P<listing_id>\w+)/$", ListingConsumer.as_asgi()),
+            ])
+        ),
+    })
+    watchers = await connect_listing_watchers(application, listing, 200)
+    commenter = WebsocketCommunicator(application,
+                                      "ws" + reverse("market:details", kwargs={"listing_id": listing.id}), headers)
+    connected, subprotocol = await commenter.connect()
+    assert connected
+
+    context = await start_capture_queries()
+    # Queries on the event loop itself would raise SynchronousOnlyOperation, so only executor thread is captured
+    with mock.patch("django.core.files.storage.FileSystemStorage.url") as storage_url:
+        await commenter.send_json_to({"post_comment": "new_comment", "listing_id": listing.id})
+        responses = await asyncio.gather(*[watcher.receive_json_from() for watcher in watchers + [commenter]])
+    queries = await stop_capture_queries(context)
+
+    assert {response['username'] for response in responses} == {user_2.username}
+    # Page which already renders the comment skips its replayed event by id
+    assert {response['comment_id'] for response in responses} == {
+        await database_sync_to_async(Comment.objects.values_list('id', flat=True).get)(listing=listing)
+    }
+    assert {response['avatar'] for response in responses} == {user_2.avatar.url}
+    # Listing lookup and comment insert only, none per watcher
+    assert queries == 2
+    assert not storage_url.called
+    await asyncio.gather(*[watcher.disconnect() for watcher in watchers + [commenter]])
+    await clear_all_bd(client_login)
+
+
+"""
+GROUP EVENTS - PRE-SERIALIZED FRAMES
+"""
+
+
+async def fan_out(consumers, handler_name, event):
+    for consumer in consumers:
+        await getattr(consumer, handler_name)(event)
+
+
+FAN_OUT_PAYLOAD = {
+    'comment': "new_comment" * 20,
+    'username': "fan_out_user",
+    'comment_date': "Jan 01, 10:00 am",
+    'avatar': "/media/default-user.png",
+}
+
+
+def fan_out_consumers(subscribers, sent):
+    async def send(text_data=None, bytes_data=None, close=False):
+        sent.append(text_data)
+
+    consumers = [ListingConsumer() for _ in range(subscribers)]
+    for consumer in consumers:
+        consumer.send = send
+    return consumers
+
+
+def patch_frame_dumps(settings):
+    # Cached dumps of the backend is replaced only inside the block, patch.dict restores the cache after it
+    dumps = mock.Mock(wraps=json.dumps)
+    return mock.patch.dict(frames._dumps, {settings.WEBSOCKET_JSON_BACKEND: dumps}), dumps
+
+
+@pytest.mark.asyncio
+async def test_group_event_serialized_once(settings):
+    """
+    Frame is serialized exactly once by the sender, handlers of every subscriber only forward ready text
+    """
+    sent = []
+    consumers = fan_out_consumers(100, sent)
+    patch, dumps = patch_frame_dumps(settings)
+    with patch:
+        event = frame_event('post_new_comment', FAN_OUT_PAYLOAD)
+        await fan_out(consumers, 'post_new_comment', event)
+    dumps.assert_called_once_with(FAN_OUT_PAYLOAD)
+    assert sent == [event['frame']] * 100
+    assert json.loads(sent[0]) == FAN_OUT_PAYLOAD
+
+
+@pytest.mark.skipif(not os.environ.get("RUN_BENCHMARKS"), reason="Wall clock benchmark, set RUN_BENCHMARKS=1 to run it")
+@pytest.mark.asyncio
+@pytest.mark.parametrize("subscribers", [1000, 10000])
+async def test_group_event_fan_out_cost(subscribers, settings):
+    """
+    Fan-out of pre-serialized frame to 1k/10k subscribers next to re-serializing payload per socket.
+    """
+    sent = []
+    consumers = fan_out_consumers(subscribers, sent)
+    patch, dumps = patch_frame_dumps(settings)
+    with patch:
+        start = time.perf_counter()
+        event = frame_event('post_new_comment', FAN_OUT_PAYLOAD)
+        await fan_out(consumers, 'post_new_comment', event)
+        frame_time = time.perf_counter() - start
+    assert dumps.call_count == 1
+    assert sent == [event['frame']] * subscribers
+
+    start = time.perf_counter()
+    for consumer in consumers:
+        await consumer.send(text_data=json.dumps(FAN_OUT_PAYLOAD))
+    per_socket_time = time.perf_counter() - start
+    print(f"{subscribers} subscribers: pre-serialized {frame_time * 1000:.3f}ms, "
+          f"per socket json.dumps {per_socket_time * 1000:.3f}ms")
+
+
+"""
+LISTING CONSUMER - BID BROADCAST COALESCING
+"""
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_listing_new_bid_placement_coalesced(settings):
+    """
+    With BID_BROADCAST_WINDOW bidder gets acknowledgement of every bid, watchers get at most one update per window
+    with the latest price, bid count and leader
+    """
+    settings.BID_BROADCAST_WINDOW = 0.05
+    client = Client()
+    user = await async_create_user(username="coalesce_owner", password="test_password")
+    user_2 = await async_create_user(username="coalesce_bidder", password="test_password")
+    client_login = await async_login_client(client, "coalesce_bidder", "test_password")
+    category = await async_create_category(name="test_category")
+    listing = await async_create_listing(name="test_listing", image="None", description="test_desc", category=category,
+                                         user=user, startBid=100, days=30, active=True)
+    headers = [(b'origin', b'...'), (b'cookie', client_login.cookies.output(header='', sep='; ').encode())]
+    application = ProtocolTypeRouter({
+        "http": get_asgi_application(),
+
+        "websocket": AuthMiddlewareStack(
+            URLRouter([
+                re_path(r"^ws/market/(?P<listing_id>\w+)/$", ListingConsumer.as_asgi()),
+            ])
+        ),
+    })
+    watcher, = await connect_listing_watchers(application, listing, 1)
+    bidder = WebsocketCommunicator(application,
+                                   "ws" + reverse("market:details", kwargs={"listing_id": listing.id}), headers)
+    connected, subprotocol = await bidder.connect()
+    assert connected
+
+    bids_count = 20
+    start = time.perf_counter()
+    for value in range(101, 101 + bids_count):
+        await bidder.send_json_to({"newbid": f"{value}", "listing_id": listing.id})
+        response = await bidder.receive_json_from()
+        while 'send_self' not in response:
+            response = await bidder.receive_json_from()
+        assert response == {'new_bid_set': f"{float(value)}", 'send_self': 'yes'}
+    elapsed = time.perf_counter() - start
+
+    updates = []
+    while not await watcher.receive_nothing(timeout=settings.BID_BROADCAST_WINDOW * 4):
+        updates.append(await watcher.receive_json_from())
+    assert 1 <= len(updates) <= elapsed // settings.BID_BROADCAST_WINDOW + 2
+    assert updates[-1] == {
+        'new_bid_set': f"{float(100 + bids_count)}",
+        'bid_count': bids_count,
+        'leader': user_2.username,
+    }
+    await watcher.disconnect()
+    await bidder.disconnect()
+    await clear_all_bd(client_login)
+
+
+"""
+LISTING CONSUMER - RESUME FROM SEQUENCE NUMBER
+"""
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_listing_resume_from_replays_missed_events():
+    """
+    Socket connected with "resume_from" gets only events after given sequence number, then live events with "seq".
+    Sockets without "resume_from" get events without "seq".
+    """
+    await database_sync_to_async(cache.clear)()
+    client = Client()
+    user = await async_create_user(username="resume_owner", password="test_password")
+    user_2 = await async_create_user(username="resume_bidder", password="test_password")
+    client_login = await async_login_client(client, "resume_bidder", "test_password")
+    category = await async_create_category(name="test_category")
+    listing = await async_create_listing(name="test_listing", image="None", description="test_desc", category=category,
+                                         user=user, startBid=100, days=30, active=True)
+    headers = [(b'origin', b'...'), (b'cookie', client_login.cookies.output(header='', sep='; ').encode())]
+    application = ProtocolTypeRouter({
+        "http": get_asgi_application(),
+
+        "websocket": AuthMiddlewareStack(
+            URLRouter([
+                re_path(r"^ws/market/(?P<listing_id>\w+)/$", ListingConsumer.as_asgi()),
+            ])
+        ),
+    })
+    path = "ws" + reverse("market:details", kwargs={"listing_id": listing.id})
+    bidder = WebsocketCommunicator(application, path, headers)
+    connected, subprotocol = await bidder.connect()
+    assert connected
+    for value in (200, 300, 400):
+        await bidder.send_json_to({"newbid": f"{value}", "listing_id": listing.id})
+        assert await bidder.receive_json_from() == {'new_bid_set': f"{float(value)}"}
+
+    resumed = WebsocketCommunicator(application, f"{path}?resume_from=1")
+    connected, subprotocol = await resumed.connect()
+    assert connected
+    assert await resumed.receive_json_from() == {'new_bid_set': "300.0", 'seq': 2}
+    assert await resumed.receive_json_from() == {'new_bid_set': "400.0", 'seq': 3}
+    assert await resumed.receive_nothing()
+
+    await bidder.send_json_to({"newbid": "500", "listing_id": listing.id})
+    assert await bidder.receive_json_from() == {'new_bid_set': "500.0"}
+    assert await resumed.receive_json_from() == {'new_bid_set': "500.0", 'seq': 4}
+
+    up_to_date = WebsocketCommunicator(application, f"{path}?resume_from=4")
+    connected, subprotocol = await up_to_date.connect()
+    assert connected
+    assert await up_to_date.receive_nothing()
+
+    await asyncio.gather(*[communicator.disconnect() for communicator in (bidder, resumed, up_to_date)])
+    await clear_all_bd(client_login)
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_listing_resume_from_lost_events(settings):
+    """
+    If missed events already left ring buffer or sequence is unknown, socket is asked to resync
+    """
+    await database_sync_to_async(cache.clear)()
+    settings.LISTING_EVENTS_BUFFER_SIZE = 2
+    client = Client()
+    user = await async_create_user(username="resync_owner", password="test_password")
+    user_2 = await async_create_user(username="resync_bidder", password="test_password")
+    client_login = await async_login_client(client, "resync_bidder", "test_password")
+    category = await async_create_category(name="test_category")
+    listing = await async_create_listing(name="test_listing", image="None", description="test_desc", category=category,
+                                         user=user, startBid=100, days=30, active=True)
+    headers = [(b'origin', b'...'), (b'cookie', client_login.cookies.output(header='', sep='; ').encode())]
+    application = ProtocolTypeRouter({
+        "http": get_asgi_application(),
+
+        "websocket": AuthMiddlewareStack(
+            URLRouter([
+                re_path(r"^ws/market/(?P<listing_id>\w+)/$", ListingConsumer.as_asgi()),
+            ])
+        ),
+    })
+    path = "ws" + reverse("market:details", kwargs={"listing_id": listing.id})
+    bidder = WebsocketCommunicator(application, path, headers)
+    connected, subprotocol = await bidder.connect()
+    assert connected
+    for value in (200, 300, 400):
+        await bidder.send_json_to({"newbid": f"{value}", "listing_id": listing.id})
+        await bidder.receive_json_from()
+
+    for resume_from in (0, 10):
+        resumed = WebsocketCommunicator(application, f"{path}?resume_from={resume_from}")
+        connected, subprotocol = await resumed.connect()
+        assert connected
+        assert await resumed.receive_json_from() == {'resync': 'yes'}
+        await resumed.disconnect()
+    await bidder.disconnect()
+    await clear_all_bd(client_login)
+
+
+"""
+NOTIFICATION CONSUMER
+"""
+
+
+def notifications_application():
+    return ProtocolTypeRouter({
+        "http": get_asgi_application(),
+
+        "websocket": AuthMiddlewareStack(
+            URLRouter([
+                re_path(r"^ws/market/notifications/$", NotificationConsumer.as_asgi()),
+            ])
+        ),
+    })
+
+
+async def connect_notifications(application, username):
+    client_login = await async_login_client(Client(), username, "test_password")
+    headers = [(b'origin', b'...'), (b'cookie', client_login.cookies.output(header='', sep='; ').encode())]
+    communicator = WebsocketCommunicator(application, "ws/market/notifications/", headers)
+    connected, subprotocol = await communicator.connect()
+    assert connected
+    return communicator
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_notification_outbid():
+    """
+    Previous leader is notified when his bid is beaten, new leader gets nothing
+    """
+    owner = await async_create_user(username="outbid_owner", password="test_password")
+    first = await async_create_user(username="outbid_first", password="test_password")
+    second = await async_create_user(username="outbid_second", password="test_password")
+    category = await async_create_category(name="test_category")
+    listing = await async_create_listing(name="test_listing", image="None", description="test_desc", category=category,
+                                         user=owner, startBid=100, days=30, active=True)
+    application = notifications_application()
+    first_socket = await connect_notifications(application, "outbid_first")
+    second_socket = await connect_notifications(application, "outbid_second")
+
+    await database_sync_to_async(place_bid)(listing, first, 200)
+    assert await first_socket.receive_nothing()
+    await database_sync_to_async(place_bid)(listing, second, 300)
+    assert await first_socket.receive_json_from() == {
+        'notification': 'outbid', 'listing_id': listing.id, 'listing_name': "test_listing", 'price': "300.00"
+    }
+    assert await second_socket.receive_nothing()
+
+    await first_socket.disconnect()
+    await second_socket.disconnect()
+    await clear_all_bd()
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db
+async def test_notification_ending_soon(settings):
+    """
+    Every watcher of the listing ending soon is notified once, watchers are read in chunks
+    """
+    settings.WATCHERS_NOTIFY_CHUNK_SIZE = 2
+    owner = await async_create_user(username="ending_owner", password="test_password")
+    category = await async_create_category(name="test_category")
+    listing = await async_create_listing(name="test_listing", image="None", description="test_desc", category=category,
+                                         user=owner, startBid=100, days=0, active=True)
+    await database_sync_to_async(AuctionListing.objects.filter(pk=listing.pk).update)(
+        endDate=timezone.now() + datetime.timedelta(minutes=2)
+    )
+    application = notifications_application()
+    sockets = []
+    for i in range(3):
+        watcher = await async_create_user(username=f"ending_watcher_{i}", password="test_password")
+        await database_sync_to_async(watcher.watchlist.add)(listing)
+        sockets.append(await connect_notifications(application, f"ending_watcher_{i}"))
+    owner_socket = await connect_notifications(application, "ending_owner")
+
+    context = await start_capture_queries()
+    assert await database_sync_to_async(notify_ending_soon)() == 1
+    queries = await stop_capture_queries(context)
+    responses = await asyncio.gather(*[socket.receive_json_from() for socket in sockets])
+    assert {response['notification'] for response in responses} == {'ending_soon'}
+    assert {response['listing_id'] for response in responses} == {listing.id}
+    # Listings, claim and two chunks of watchers
+    assert queries == 4
+    assert await owner_socket.receive_nothing()
+    assert await database_sync_to_async(notify_ending_soon)() == 0
+    assert await sockets[0].receive_nothing()
+
+    await asyncio.gather(*[socket.disconnect() for socket in sockets + [owner_socket]])
+    await clear_all_bd()
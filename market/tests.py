@@ -1,11 +1,35 @@
 import datetime
+import json
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipUnless
+
 import pytest
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.urls import reverse
 
-from .models import User, Category, AuctionListing, Bid, Comment, Chat, Message
+from . import bidding, frames
+from .checks import shared_cache_check
+from .bidding import place_bid
+from .events import last_seq, listing_event, missed_frames
+from .listings import NO_IMAGE_URL
+from .models import LISTING_PRICE, User, Category, AuctionListing, Bid, Comment, Chat, Message
+from .settlement import settle_listings
+from .pagination import decode_cursor, encode_cursor, keyset_q
+from .tasks import close_expired_listings, create_task, notify_ending_soon, settle_listing
+from .views import LISTING_GRID_SORTS
 
 
 def create_user(username, password):
@@ -269,6 +293,24 @@ class ListingCreationViewTests(TestCase):
         response = self.client.post(reverse("market:createListing"), post_data)
         self.assertURLEqual(response.url, reverse("market:createListing"))
 
+    def test_out_of_range_expiretime_and_start_bid_post_data(self):
+        """
+        If expiretime overflows the end date or startBid is not a finite number - Redirect to create listing page
+        """
+        user = create_user(username="test_user", password="password")
+        category = create_category(name="category_1")
+        self.client.login(username="test_user", password="password")
+        for start_bid, hours in (("100", "100000000000"), ("nan", "12"), ("inf", "12")):
+            post_data = {"listingname": "Test_Listing",
+                         "category": category.id,
+                         "startBid": start_bid,
+                         "imageurl": "None",
+                         "listingdesc": "Test_Description",
+                         "expiretime": hours}
+            response = self.client.post(reverse("market:createListing"), post_data)
+            self.assertURLEqual(response.url, reverse("market:createListing"))
+        self.assertFalse(AuctionListing.objects.exists())
+
     def test_incorrect_imageurl_value_post_data(self):
         """
         If imageurl POST data is numeric - Redirect to created listing page
@@ -1791,3 +1833,1392 @@ class DetailsViewTests(TestCase):
         self.assertNotContains(response, 'id = "edit-listing"')
         self.assertNotContains(response, 'id = "end-listing-submit"')
         self.assertNotContains(response, 'id = "delete-listing"')
+
+
+class ListingBidSummaryTests(TestCase):
+    def test_new_listing_summary(self):
+        """
+        New listing without bids has current price equal to start bid, zero bids and no leading bid
+        """
+        user_1 = create_user(username="test_user_1", password="password_1")
+        category_1 = create_category(name="category_1")
+        listing = create_listing(name="listing_1", image="None", description="test_desc", category=category_1,
+                                 user=user_1, startBid=100, days=30, active=True)
+        listing.refresh_from_db()
+        self.assertEqual(listing.current_price, 100)
+        self.assertEqual(listing.bid_count, 0)
+        self.assertIsNone(listing.leading_bid)
+
+    def test_bids_update_summary(self):
+        """
+        Every created bid increments bid count, the highest bid becomes current price and leading bid
+        """
+        user_1 = create_user(username="test_user_1", password="password_1")
+        user_2 = create_user(username="test_user_2", password="password_2")
+        category_1 = create_category(name="category_1")
+        listing = create_listing(name="listing_1", image="None", description="test_desc", category=category_1,
+                                 user=user_1, startBid=100, days=30, active=True)
+        bid_1 = Bid.objects.create(value=150, listing=listing, user=user_2, date=timezone.now())
+        bid_2 = Bid.objects.create(value=120, listing=listing, user=user_2, date=timezone.now())
+        listing.refresh_from_db()
+        self.assertEqual(listing.current_price, 150)
+        self.assertEqual(listing.bid_count, 2)
+        self.assertEqual(listing.leading_bid, bid_1)
+        bid_3 = Bid.objects.create(value=200.55, listing=listing, user=user_2, date=timezone.now())
+        listing.refresh_from_db()
+        self.assertEqual(float(listing.current_price), 200.55)
+        self.assertEqual(listing.bid_count, 3)
+        self.assertEqual(listing.leading_bid, bid_3)
+
+    def test_makebid_updates_summary(self):
+        """
+        Bid placed by makebid view is reflected in listing's summary columns
+        """
+        user_1 = create_user(username="test_user_1", password="password_1")
+        create_user(username="test_user_2", password="password_2")
+        category_1 = create_category(name="category_1")
+        listing = create_listing(name="listing_1", image="None", description="test_desc", category=category_1,
+                                 user=user_1, startBid=100, days=30, active=True)
+        self.client.login(username="test_user_2", password="password_2")
+        self.client.post(reverse("market:makebid", kwargs={"listing_id": listing.id}), {"newbid": "150"})
+        self.client.post(reverse("market:makebid", kwargs={"listing_id": listing.id}), {"newbid": "140"})
+        listing.refresh_from_db()
+        self.assertEqual(listing.current_price, 150)
+        self.assertEqual(listing.bid_count, 1)
+        self.assertEqual(listing.leading_bid.value, 150)
+
+    def test_sync_listing_bids_command_repairs_summary(self):
+        """
+        sync_listing_bids command restores summary columns that went out of date
+        """
+        user_1 = create_user(username="test_user_1", password="password_1")
+        user_2 = create_user(username="test_user_2", password="password_2")
+        category_1 = create_category(name="category_1")
+        listing = create_listing(name="listing_1", image="None", description="test_desc", category=category_1,
+                                 user=user_1, startBid=100, days=30, active=True)
+        bid = Bid.objects.create(value=150, listing=listing, user=user_2, date=timezone.now())
+        AuctionListing.objects.filter(pk=listing.pk).update(current_price=None, bid_count=0, leading_bid=None)
+        out = StringIO()
+        call_command("sync_listing_bids", stdout=out)
+        listing.refresh_from_db()
+        self.assertEqual(listing.current_price, 150)
+        self.assertEqual(listing.bid_count, 1)
+        self.assertEqual(listing.leading_bid, bid)
+        self.assertIn("repaired 1", out.getvalue())
+
+    def test_sync_listing_bids_keeps_equal_bids_leader(self):
+        """
+        Latest of equal bids leads both after Bid.save() and after repair, so consistent listing isn't repaired
+        even if the instance in memory is out of date
+        """
+        user_1 = create_user(username="test_user_1", password="password_1")
+        user_2 = create_user(username="test_user_2", password="password_2")
+        user_3 = create_user(username="test_user_3", password="password_3")
+        category_1 = create_category(name="category_1")
+        listing = create_listing(name="listing_1", image="None", description="test_desc", category=category_1,
+                                 user=user_1, startBid=100, days=30, active=True)
+        date = timezone.now()
+        Bid.objects.create(value=150, listing=listing, user=user_2, date=date)
+        latest = Bid.objects.create(value=150, listing=listing, user=user_3, date=date)
+        self.assertEqual(AuctionListing.objects.get(pk=listing.pk).leading_bid, latest)
+        self.assertFalse(listing.refresh_bid_summary())
+        self.assertEqual(listing.leading_bid_id, latest.id)
+        out = StringIO()
+        call_command("sync_listing_bids", stdout=out)
+        self.assertIn("repaired 0", out.getvalue())
+
+
+class BidPlacementServiceTests(TestCase):
+    def setUp(self):
+        self.owner = create_user(username="test_user_1", password="password_1")
+        self.bidder = create_user(username="test_user_2", password="password_2")
+        category_1 = create_category(name="category_1")
+        self.listing = create_listing(name="listing_1", image="None", description="test_desc", category=category_1,
+                                      user=self.owner, startBid=100, days=30, active=True)
+
+    def test_accepted_bid(self):
+        """
+        Bid bigger than current price is accepted and becomes listing's current price
+        """
+        result = place_bid(self.listing, self.bidder, "150.555")
+        self.assertTrue(result.accepted)
+        self.assertEqual(str(result.price), "150.56")
+        self.assertEqual(result.bid.value, result.price)
+
+    def test_rejected_bids(self):
+        """
+        Owner's, non-numeric, too big, not bigger than current price and inactive listing's bids are rejected
+        """
+        self.assertEqual(place_bid(self.listing, self.owner, "150").reason, bidding.OWNER)
+        self.assertEqual(place_bid(self.listing, self.bidder, "qwerty").reason, bidding.NON_NUMERIC)
+        self.assertEqual(place_bid(self.listing, self.bidder, "100000").reason, bidding.OUT_OF_RANGE)
+        self.assertEqual(place_bid(self.listing, self.bidder, "100").reason, bidding.TOO_LOW)
+        place_bid(self.listing, self.bidder, "150")
+        result = place_bid(self.listing, self.bidder, "150")
+        self.assertEqual(result.reason, bidding.TOO_LOW)
+        self.assertEqual(result.price, 150)
+        AuctionListing.objects.filter(pk=self.listing.pk).update(active=False)
+        self.assertEqual(place_bid(self.listing, self.bidder, "200").reason, bidding.INACTIVE)
+        self.assertEqual(Bid.objects.filter(listing=self.listing).count(), 1)
+
+    def test_ended_listing_not_closed_yet(self):
+        """
+        Listing whose end date has passed, but which wasn't closed by the periodic closer yet, rejects bids
+        """
+        AuctionListing.objects.filter(pk=self.listing.pk).update(endDate=timezone.now() - datetime.timedelta(seconds=1))
+        result = place_bid(self.listing, self.bidder, "150")
+        self.assertEqual((result.accepted, result.reason, result.price), (False, bidding.INACTIVE, 100))
+        self.assertFalse(Bid.objects.filter(listing=self.listing).exists())
+
+
+class BidPlacementConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            self.skipTest("Concurrent writers need PostgreSQL or file based SQLite test database")
+
+    def test_parallel_bids_accept_strictly_increasing_sequence(self):
+        """
+        If hundreds of bids are placed in parallel on one listing, accepted bids form strictly increasing sequence
+        and listing's current price is the biggest accepted value
+        """
+        user_1 = create_user(username="test_user_1", password="password_1")
+        bidders = [create_user(username=f"bidder_{i}", password="password") for i in range(8)]
+        category_1 = create_category(name="category_1")
+        listing = create_listing(name="listing_1", image="None", description="test_desc", category=category_1,
+                                 user=user_1, startBid=100, days=30, active=True)
+        values = [100 + i for i in range(300)]
+        random.Random(1).shuffle(values)
+
+        def make_bid(i):
+            try:
+                return place_bid(listing, bidders[i % len(bidders)], values[i])
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(make_bid, range(len(values))))
+
+        accepted = list(Bid.objects.filter(listing=listing).order_by("id").values_list("value", flat=True))
+        self.assertEqual(len(accepted), len([result for result in results if result.accepted]))
+        self.assertEqual(accepted, sorted(set(accepted)))
+        listing.refresh_from_db()
+        self.assertEqual(listing.current_price, accepted[-1])
+        self.assertEqual(listing.bid_count, len(accepted))
+        self.assertEqual(listing.leading_bid.value, accepted[-1])
+
+
+class BidPlacementInterleavingTests(TestCase):
+    """
+    Interleavings of two bidders that run on the in-memory test database,
+    the parallel stress test above needs PostgreSQL or file based SQLite
+    """
+
+    def setUp(self):
+        owner = create_user(username="test_user_1", password="password_1")
+        self.bidder_1 = create_user(username="test_user_2", password="password_2")
+        self.bidder_2 = create_user(username="test_user_3", password="password_3")
+        category_1 = create_category(name="category_1")
+        self.listing = create_listing(name="listing_1", image="None", description="test_desc", category=category_1,
+                                      user=owner, startBid=100, days=30, active=True)
+
+    def test_claims_of_stale_snapshots(self):
+        """
+        Both bidders loaded the listing at price 100 before either claimed it, the second claim with the same or
+        lower value is rejected by the conditional UPDATE although its snapshot still shows 100
+        """
+        snapshot_1 = AuctionListing.objects.get(pk=self.listing.pk)
+        snapshot_2 = AuctionListing.objects.get(pk=self.listing.pk)
+        self.assertTrue(place_bid(snapshot_1, self.bidder_1, "150").accepted)
+        self.assertEqual(snapshot_2.current_price, 100)
+        equal = place_bid(snapshot_2, self.bidder_2, "150")
+        lower = place_bid(snapshot_2, self.bidder_2, "120")
+        self.assertEqual((equal.accepted, equal.reason, equal.price), (False, bidding.TOO_LOW, 150))
+        self.assertEqual((lower.accepted, lower.reason, lower.price), (False, bidding.TOO_LOW, 150))
+        self.assertEqual(list(Bid.objects.filter(listing=self.listing).values_list("user", "value")),
+                         [(self.bidder_1.id, 150)])
+
+    def test_claim_between_update_and_bid_insert(self):
+        """
+        Second bidder arrives after the first claim UPDATE but before its bid row is inserted,
+        the same and lower values are rejected, only the bigger one is accepted and leads
+        """
+        results = []
+        create_bid = Bid.objects.create
+
+        def interleave(**kwargs):
+            if kwargs["user"] == self.bidder_1:
+                for value in ("150", "120", "160"):
+                    results.append(place_bid(self.listing, self.bidder_2, value))
+            return create_bid(**kwargs)
+
+        with mock.patch.object(Bid.objects, "create", side_effect=interleave):
+            first = place_bid(self.listing, self.bidder_1, "150")
+        self.assertTrue(first.accepted)
+        self.assertEqual([(result.accepted, result.reason) for result in results],
+                         [(False, bidding.TOO_LOW), (False, bidding.TOO_LOW), (True, None)])
+        self.listing.refresh_from_db()
+        self.assertEqual(self.listing.current_price, 160)
+        self.assertEqual(self.listing.bid_count, 2)
+        self.assertEqual(self.listing.leading_bid.user, self.bidder_2)
+
+
+class QueryPlanTests(TestCase):
+    """
+    Hot queries must be answered by an index, not by a sequential scan of the table
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = create_user(username="test_user_1", password="password_1")
+        cls.bidder = create_user(username="test_user_2", password="password_2")
+        cls.category = create_category(name="category_1")
+        date = timezone.now()
+        AuctionListing.objects.bulk_create([
+            AuctionListing(name=f"listing_{i}", image="None", description="test_desc", category=cls.category,
+                           user=cls.owner, startBid=100, current_price=100, creationDate=date,
+                           endDate=date + datetime.timedelta(days=i % 30), active=bool(i % 2))
+            for i in range(200)
+        ])
+        listings = list(AuctionListing.objects.order_by("id"))
+        cls.listing = listings[0]
+        Bid.objects.bulk_create([
+            Bid(value=100 + i, listing=listings[i % 20], user=cls.bidder, date=date) for i in range(400)
+        ])
+        Comment.objects.bulk_create([
+            Comment(text="comment", listing=listings[i % 20], user=cls.bidder, date=date) for i in range(400)
+        ])
+        chats = [Chat.objects.create() for i in range(20)]
+        cls.chat = chats[0]
+        Message.objects.bulk_create([
+            Message(text="message", chat=chats[i % 20], sender=cls.bidder, receiver=cls.owner, date=date,
+                    unread=bool(i % 3)) for i in range(400)
+        ])
+
+    def assertUsesIndex(self, queryset, index):
+        """
+        Plan of the query must name the expected index, any other index (e.g. of the foreign key) doesn't count
+        """
+        plan = queryset.explain()
+        self.assertIn(index, plan, plan)
+
+    def test_bid_queries(self):
+        self.assertUsesIndex(Bid.objects.filter(listing=self.listing).order_by("-value")[:1], "bid_listing_value_idx")
+        self.assertUsesIndex(Bid.objects.filter(listing=self.listing).order_by("date"), "bid_listing_date_idx")
+
+    def test_comment_queries(self):
+        self.assertUsesIndex(Comment.objects.filter(listing=self.listing).order_by("date"), "comment_listing_date_idx")
+
+    def test_message_queries(self):
+        self.assertUsesIndex(Message.objects.filter(chat=self.chat).order_by("date"), "message_chat_date_idx")
+        self.assertUsesIndex(Message.objects.filter(chat=self.chat, unread=True), "message_chat_unread_idx")
+        self.assertUsesIndex(Message.objects.filter(receiver=self.owner, unread=True), "message_receiver_unread_idx")
+
+    def test_listing_queries(self):
+        self.assertUsesIndex(AuctionListing.objects.filter(active=True, endDate__lte=timezone.now())
+                             .order_by("endDate"), "listing_active_end_id_idx")
+
+    def test_listing_grid_queries(self):
+        listing = AuctionListing.objects.annotate(price=LISTING_PRICE).order_by("id")[100]
+        grids = (
+            (AuctionListing.objects.all(), {"ending": "listing_enddate_id_idx", "newest": "listing_created_id_idx"}),
+            (AuctionListing.objects.filter(active=True), {"ending": "listing_active_end_id_idx",
+                                                          "newest": "listing_active_created_idx",
+                                                          "price": "listing_active_price_idx"}),
+            (AuctionListing.objects.filter(category=self.category), {"ending": "listing_category_enddate_idx",
+                                                                     "newest": "listing_category_created_idx"}),
+        )
+        for listings, indexes in grids:
+            # Like listing_grid, price sort orders by the indexed expression
+            listings = listings.annotate(price=LISTING_PRICE)
+            for sort, index in indexes.items():
+                fields, descending = LISTING_GRID_SORTS[sort]
+                cursor = encode_cursor(*[getattr(listing, field) for field in fields])
+                with self.subTest(sort=sort, query=str(listings.query)):
+                    for page_cursor in (None, cursor):
+                        queryset = listings.order_by(*[f"-{field}" if descending else field for field in fields])
+                        if page_cursor:
+                            model_fields = [listings.query.annotations[field].output_field if field == "price"
+                                            else AuctionListing._meta.get_field(field) for field in fields]
+                            queryset = queryset.filter(keyset_q(fields, decode_cursor(page_cursor, model_fields),
+                                                                descending))
+                        self.assertUsesIndex(queryset[:24], index)
+
+
+class InboxQueryCountTests(TestCase):
+    def create_chats(self, user, count):
+        for i in range(count):
+            member = create_user(username=f"member_{user.username}_{i}", password="password")
+            chat = Chat.objects.create()
+            chat.members.add(user, member)
+            Message.objects.create(text=f"message_{i}", sender=member, receiver=user, chat=chat)
+            Message.objects.create(text=f"answer_{i}", sender=user, receiver=member, chat=chat)
+        return chat
+
+    def get_inbox_queries_count(self, username, chats_count, open_chat=False):
+        user = create_user(username=username, password="password")
+        chat = self.create_chats(user, chats_count)
+        self.client.login(username=username, password="password")
+        url = reverse("market:chat", kwargs={"chat_id": chat.id}) if open_chat else reverse("market:inbox")
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context["chats"]), chats_count)
+        return len(context)
+
+    def test_inbox_queries_count_does_not_depend_on_chats_count(self):
+        """
+        Inbox page issues the same number of queries for one and for ten chats
+        """
+        self.assertEqual(self.get_inbox_queries_count("test_user_1", 1),
+                         self.get_inbox_queries_count("test_user_2", 10))
+
+    def test_open_chat_queries_count_does_not_depend_on_chats_count(self):
+        """
+        Opened chat page issues the same number of queries for one and for ten chats
+        """
+        self.assertEqual(self.get_inbox_queries_count("test_user_1", 1, open_chat=True),
+                         self.get_inbox_queries_count("test_user_2", 10, open_chat=True))
+
+    def test_inbox_chat_summaries(self):
+        """
+        Inbox shows last message preview and unread counter of other member's messages, opening chat marks them read
+        """
+        user = create_user(username="test_user_1", password="password")
+        chat = self.create_chats(user, 1)
+        self.client.login(username="test_user_1", password="password")
+        with self.assertNumQueries(6):
+            response = self.client.get(reverse("market:inbox"))
+        self.assertEqual(response.context["chats"][0]["preview"], ["answer_0..."])
+        self.assertEqual(response.context["chats"][0]["unread"], 1)
+        response = self.client.get(reverse("market:chat", kwargs={"chat_id": chat.id}))
+        self.assertEqual(response.context["chats"][0]["unread"], 0)
+        self.assertFalse(Message.objects.filter(chat=chat, unread=True, receiver=user).exists())
+        self.assertTrue(Message.objects.filter(chat=chat, unread=True, sender=user).exists())
+
+    def test_inbox_unread_counts_received_messages_only(self):
+        """
+        Unread counter of the chat counts the same messages as inbox counter and opening the chat clears it:
+        message without receiver isn't counted
+        """
+        user = create_user(username="test_user_1", password="password")
+        chat = self.create_chats(user, 1)
+        Message.objects.create(text="no_receiver", sender=chat.members.exclude(pk=user.pk).get(), chat=chat)
+        self.client.login(username="test_user_1", password="password")
+        response = self.client.get(reverse("market:inbox"))
+        self.assertEqual(response.context["chats"][0]["unread"], 1)
+        self.assertEqual(response.context["user"].inbox, 1)
+        response = self.client.get(reverse("market:chat", kwargs={"chat_id": chat.id}))
+        self.assertEqual(response.context["chats"][0]["unread"], 0)
+
+
+class CloseExpiredListingsTests(TestCase):
+    def setUp(self):
+        self.owner = create_user(username="test_user_1", password="password_1")
+        self.bidder = create_user(username="test_user_2", password="password_2")
+        self.category = create_category(name="category_1")
+
+    def test_expired_listings_closed_in_batches(self):
+        """
+        All active listings with passed end date are closed, even if there are more of them than batch size.
+        Listings that are not ended yet stay active
+        """
+        expired = [create_listing(name=f"listing_{i}", image="None", description="test_desc", category=self.category,
+                                  user=self.owner, startBid=100, days=-1, active=True) for i in range(5)]
+        future = create_listing(name="listing_future", image="None", description="test_desc", category=self.category,
+                                user=self.owner, startBid=100, days=1, active=True)
+        self.assertEqual(close_expired_listings(batch_size=2), 5)
+        self.assertFalse(AuctionListing.objects.filter(id__in=[listing.id for listing in expired], active=True).exists())
+        future.refresh_from_db()
+        self.assertTrue(future.active)
+
+    def test_closing_is_idempotent(self):
+        """
+        Winner gets listing in winlist and one message from owner, repeated closing changes nothing
+        """
+        listing = create_listing(name="listing_1", image="None", description="test_desc", category=self.category,
+                                 user=self.owner, startBid=100, days=-1, active=True)
+        Bid.objects.create(value=150, listing=listing, user=self.bidder, date=timezone.now())
+        self.assertEqual(close_expired_listings(), 1)
+        self.assertEqual(close_expired_listings(), 0)
+        self.assertEqual(create_task(listing.id), False)
+        self.assertQuerysetEqual(self.bidder.winlist.all(), [listing])
+        self.assertEqual(Message.objects.filter(sender=self.owner).count(), 1)
+
+    def test_listing_date_checker_command(self):
+        """
+        listing_date_checker command closes already expired listings at once
+        """
+        listing = create_listing(name="listing_1", image="None", description="test_desc", category=self.category,
+                                 user=self.owner, startBid=100, days=-1, active=True)
+        out = StringIO()
+        call_command("listing_date_checker", stdout=out)
+        listing.refresh_from_db()
+        self.assertFalse(listing.active)
+        self.assertIn("Closed 1", out.getvalue())
+
+
+class SettleListingsTests(TestCase):
+    def setUp(self):
+        self.owner = create_user(username="test_user_1", password="password_1")
+        self.category = create_category(name="category_1")
+
+    def create_won_listings(self, count, prefix):
+        listings = []
+        for i in range(count):
+            winner = create_user(username=f"{prefix}_{i}", password="password")
+            chat = Chat.objects.create()
+            chat.members.add(winner, self.owner)
+            listing = create_listing(name=f"{prefix}_{i}", image="None", description="test_desc",
+                                     category=self.category, user=self.owner, startBid=100, days=-1, active=True)
+            Bid.objects.create(value=150, listing=listing, user=winner, date=timezone.now())
+            listings.append(listing)
+        return AuctionListing.objects.filter(id__in=[listing.id for listing in listings])
+
+    def test_batch_settlement(self):
+        """
+        Every settled listing is closed, winner gets listing in winlist and one message in existing chat with owner.
+        Listing without bids is closed without messages
+        """
+        listings = self.create_won_listings(3, "winner")
+        no_bids = create_listing(name="no_bids", image="None", description="test_desc", category=self.category,
+                                 user=self.owner, startBid=100, days=-1, active=True)
+        settled = settle_listings(AuctionListing.objects.filter(user=self.owner))
+        self.assertEqual(len(settled), 4)
+        self.assertFalse(AuctionListing.objects.filter(active=True).exists())
+        for listing in listings:
+            winner = listing.leading_bid.user
+            self.assertQuerysetEqual(winner.winlist.all(), [listing])
+            message = Message.objects.get(receiver=winner)
+            self.assertEqual(message.sender, self.owner)
+            self.assertEqual(message.chat, Chat.objects.get(members=winner))
+        self.assertEqual(Message.objects.count(), 3)
+        self.assertEqual(Chat.objects.count(), 3)
+        self.assertEqual(settle_listings(AuctionListing.objects.filter(id=no_bids.id)), [])
+
+    def test_settlement_creates_missing_chat(self):
+        """
+        If winner and owner have no chat yet, settlement creates it
+        """
+        winner = create_user(username="test_user_2", password="password_2")
+        listing = create_listing(name="listing_1", image="None", description="test_desc", category=self.category,
+                                 user=self.owner, startBid=100, days=-1, active=True)
+        Bid.objects.create(value=150, listing=listing, user=winner, date=timezone.now())
+        settle_listings(AuctionListing.objects.filter(id=listing.id))
+        chat = Chat.objects.get(members=winner)
+        self.assertQuerysetEqual(chat.members.order_by("id"), [self.owner, winner])
+        self.assertEqual(chat.message_set.get().receiver, winner)
+
+    def test_owner_ended_listing_waits_for_lock(self):
+        """
+        Listing ended by owner waits for the row lock held by a bid instead of skipping it
+        """
+        listing = create_listing(name="listing_1", image="None", description="test_desc", category=self.category,
+                                 user=self.owner, startBid=100, days=1, active=True)
+        with mock.patch("market.tasks.settle_listings", wraps=settle_listings) as settle:
+            self.assertTrue(settle_listing(listing.id))
+        self.assertFalse(settle.call_args.kwargs["skip_locked"])
+        listing.refresh_from_db()
+        self.assertFalse(listing.active)
+        self.assertFalse(settle_listing(listing.id))
+
+    def test_settlement_queries_count_does_not_depend_on_batch_size(self):
+        """
+        Settlement of a batch issues the same number of queries for two and for six listings
+        """
+        small_batch = self.create_won_listings(2, "small")
+        big_batch = self.create_won_listings(6, "big")
+        with CaptureQueriesContext(connection) as small_context:
+            settle_listings(small_batch)
+        with CaptureQueriesContext(connection) as big_context:
+            settle_listings(big_batch)
+        self.assertEqual(len(small_context), len(big_context))
+
+
+class WebsocketFramesTests(TestCase):
+    def test_frame_is_same_payload_for_every_backend(self):
+        """
+        Every available JSON backend serializes frame to text with the same payload
+        """
+        payload = {'comment': "new comment ü", 'username': "test_user", 'avatar': "/media/default-user.png"}
+        for backend in frames.BACKENDS:
+            try:
+                dumps = frames.get_dumps(backend)
+            except ImproperlyConfigured:
+                continue
+            with self.subTest(backend=backend):
+                frame = dumps(payload)
+                self.assertIsInstance(frame, str)
+                self.assertEqual(json.loads(frame), payload)
+
+    def test_frame_event_uses_backend_from_settings(self):
+        """
+        frame_event puts text serialized by WEBSOCKET_JSON_BACKEND into group event
+        """
+        with self.settings(WEBSOCKET_JSON_BACKEND="json"):
+            self.assertEqual(frames.frame_event('new_bid_listing', {'new_bid_set': "200.0"}),
+                             {'type': 'new_bid_listing', 'frame': '{"new_bid_set": "200.0"}'})
+
+    def test_unknown_backend(self):
+        """
+        Unknown JSON backend in settings raises ImproperlyConfigured
+        """
+        with self.settings(WEBSOCKET_JSON_BACKEND="pickle"):
+            with self.assertRaises(ImproperlyConfigured):
+                frames.make_frame({'new_bid_set': "200.0"})
+
+
+class ListingEventsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_events_have_increasing_sequence_numbers(self):
+        """
+        Every event of listing gets the next sequence number, listings have separate sequences
+        """
+        first = listing_event(1, 'new_bid_listing', {'new_bid_set': "200.0"})
+        second = listing_event(1, 'new_bid_listing', {'new_bid_set': "300.0"})
+        other = listing_event(2, 'new_bid_listing', {'new_bid_set': "300.0"})
+        self.assertEqual(json.loads(first['seq_frame']), {'new_bid_set': "200.0", 'seq': 1})
+        self.assertEqual(json.loads(second['seq_frame']), {'new_bid_set': "300.0", 'seq': 2})
+        self.assertEqual(json.loads(other['seq_frame']), {'new_bid_set': "300.0", 'seq': 1})
+        self.assertEqual(json.loads(second['frame']), {'new_bid_set': "300.0"})
+        self.assertEqual(last_seq(1), 2)
+
+    def test_missed_frames_from_ring_buffer(self):
+        """
+        Missed events are replayed while they are in ring buffer, older sequence numbers require resync
+        """
+        with self.settings(LISTING_EVENTS_BUFFER_SIZE=3):
+            events = [listing_event(1, 'new_bid_listing', {'new_bid_set': f"{value}.0"}) for value in range(5)]
+            self.assertEqual(missed_frames(1, 2), [event['seq_frame'] for event in events[2:]])
+            self.assertEqual(missed_frames(1, 5), [])
+            self.assertIsNone(missed_frames(1, 1))
+            self.assertIsNone(missed_frames(1, 6))
+
+
+class AllBidsApiTests(TestCase):
+    def setUp(self):
+        self.owner = create_user(username="test_user", password="password")
+        self.category = create_category(name="test_category")
+        self.listing = create_listing(name="test_listing", image="None", description="test_desc",
+                                      category=self.category, user=self.owner, startBid=100, days=30, active=True)
+        self.url = f"/market/api/{self.listing.id}/all_bids"
+
+    def create_bids(self, count, date=None):
+        """
+        Create "count" bids of different users, all bids get the same date if "date" is given
+        """
+        bids = []
+        for i in range(count):
+            user = create_user(username=f"bidder_{self.listing.bid_count + 1}", password="password")
+            bids.append(Bid.objects.create(value=self.listing.startBid + self.listing.bid_count + 1,
+                                           listing=self.listing, user=user, date=date or timezone.now()))
+            self.listing.refresh_from_db()
+        return bids
+
+    def get_all_pages(self, url):
+        values = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            values += [bid["value"] for bid in response.json()["results"]]
+            url = response.json()["next"]
+        return values, response.json()["cursor"]
+
+    def test_pages_ordered_by_date_and_id(self):
+        """
+        Bids with the same date are split between pages by id, every bid is returned once
+        """
+        bids = self.create_bids(7, date=timezone.now())
+        values, cursor = self.get_all_pages(f"{self.url}?page_size=3")
+        self.assertEqual(values, [f"{bid.value:.2f}" for bid in bids])
+
+    def test_cursor_returns_only_new_bids(self):
+        """
+        Request with cursor of the last response returns only bids made after it
+        """
+        self.create_bids(2)
+        values, cursor = self.get_all_pages(self.url)
+        new_bids = self.create_bids(2)
+        response = self.client.get(f"{self.url}?cursor={cursor}")
+        self.assertEqual([bid["value"] for bid in response.json()["results"]],
+                         [f"{bid.value:.2f}" for bid in new_bids])
+        self.assertEqual(self.client.get(f"{self.url}?cursor={response.json()['cursor']}").json()["results"], [])
+
+    def test_since(self):
+        """
+        "since" returns only bids made after given date
+        """
+        old_bids = self.create_bids(2, date=timezone.now() - datetime.timedelta(days=1))
+        new_bids = self.create_bids(2)
+        response = self.client.get(self.url, {"since": (old_bids[-1].date + datetime.timedelta(hours=1)).isoformat()})
+        self.assertEqual([bid["value"] for bid in response.json()["results"]],
+                         [f"{bid.value:.2f}" for bid in new_bids])
+
+    def test_invalid_parameters(self):
+        """
+        Broken cursor, "since" or "page_size" returns 400
+        """
+        for params in ({"cursor": "broken"}, {"since": "yesterday"}, {"page_size": "many"}):
+            with self.subTest(params=params):
+                self.assertEqual(self.client.get(self.url, params).status_code, 400)
+
+    def test_tampered_cursor(self):
+        """
+        Well-formed cursor with values which are not a date and an id returns 400
+        """
+        self.create_bids(2)
+        for cursor in (encode_cursor("garbage", 1), encode_cursor(timezone.now().isoformat(), "garbage")):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get(self.url, {"cursor": cursor}).status_code, 400)
+
+    def test_not_modified(self):
+        """
+        Poll with ETag or Last-Modified of unchanged history returns 304, a new bid changes ETag
+        """
+        self.create_bids(2)
+        response = self.client.get(self.url)
+        etag = response["ETag"]
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response["Last-Modified"]).status_code, 304)
+        self.create_bids(1)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_queries_count_does_not_depend_on_page_size(self):
+        """
+        Bids' users are loaded with bids, page of 2 and of 20 bids costs the same number of queries
+        """
+        self.create_bids(20)
+        with CaptureQueriesContext(connection) as small_context:
+            self.client.get(self.url, {"page_size": 2})
+        with CaptureQueriesContext(connection) as big_context:
+            self.client.get(self.url, {"page_size": 20})
+        self.assertEqual(len(small_context), len(big_context))
+
+
+class LastBidApiTests(TestCase):
+    # Latency budget of api/<id>/last_bid documented in GetListingBidInfoView, median of many requests
+    CACHED_BUDGET = 0.005
+    UNCACHED_BUDGET = 0.015
+
+    def setUp(self):
+        cache.clear()
+        self.owner = create_user(username="test_user", password="password")
+        self.bidder = create_user(username="test_user_2", password="password")
+        self.category = create_category(name="test_category")
+        self.listing = create_listing(name="test_listing", image="None", description="test_desc",
+                                      category=self.category, user=self.owner, startBid=100, days=30, active=True)
+        self.url = f"/market/api/{self.listing.id}/last_bid"
+
+    def make_bid(self, value):
+        with self.captureOnCommitCallbacks(execute=True):
+            return place_bid(self.listing, self.bidder, value)
+
+    def test_one_query_then_cache(self):
+        """
+        Leading bid with its user is loaded by one query, repeated request is answered from cache
+        """
+        self.make_bid(150)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(response.json()["value"], "150.00")
+        self.assertEqual(response.json()["user"]["username"], self.bidder.username)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).json(), response.json())
+
+    def test_accepted_bid_drops_cache(self):
+        """
+        After accepted bid the next request returns the new bid, not cached one
+        """
+        self.assertEqual(json.loads(self.client.get(self.url).json()), {"value": "No bids yet :)"})
+        self.make_bid(150)
+        self.assertEqual(self.client.get(self.url).json()["value"], "150.00")
+        self.make_bid(200)
+        self.assertEqual(self.client.get(self.url).json()["value"], "200.00")
+
+    @skipUnless(os.environ.get("RUN_BENCHMARKS"), "Wall clock benchmark, set RUN_BENCHMARKS=1 to run it")
+    def test_latency_budget(self):
+        """
+        Median latency of cached and uncached requests stays within the documented budget.
+        Timings depend on the machine load, so it runs only on demand, query counts above are the regular gate
+        """
+        self.make_bid(150)
+
+        def median_latency(clear_cache):
+            timings = []
+            for i in range(100):
+                if clear_cache:
+                    cache.clear()
+                start = time.perf_counter()
+                self.client.get(self.url)
+                timings.append(time.perf_counter() - start)
+            return sorted(timings)[len(timings) // 2]
+
+        uncached = median_latency(clear_cache=True)
+        cached = median_latency(clear_cache=False)
+        print(f"last_bid median latency: cached {cached * 1000:.3f}ms, uncached {uncached * 1000:.3f}ms")
+        self.assertLess(cached, self.CACHED_BUDGET)
+        self.assertLess(uncached, self.UNCACHED_BUDGET)
+
+
+class DetailFragmentCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = create_user(username="test_user", password="password")
+        self.bidder = create_user(username="test_user_2", password="password")
+        self.category = create_category(name="test_category")
+        self.listing = create_listing(name="test_listing", image="None", description="test_desc",
+                                      category=self.category, user=self.owner, startBid=100, days=30, active=True)
+        self.url = reverse("market:details", kwargs={"listing_id": self.listing.id})
+        self.client.login(username="test_user_2", password="password")
+
+    def add_comments(self, count):
+        for i in range(count):
+            Comment.objects.create(listing=self.listing, user=self.owner, date=timezone.now(), text=f"comment_{i}")
+
+    def test_cached_page_skips_fragments_queries(self):
+        """
+        Repeated hit renders listing's header, bid box and comments from cache without their queries
+        """
+        self.add_comments(5)
+        with CaptureQueriesContext(connection) as first_context:
+            self.client.get(self.url)
+        with CaptureQueriesContext(connection) as second_context:
+            response = self.client.get(self.url)
+        self.assertLess(len(second_context), len(first_context))
+        self.assertFalse([query for query in second_context.captured_queries
+                          if 'market_comment' in query['sql']])
+        self.assertContains(response, "comment_4")
+        self.assertContains(response, "Comments (5)")
+
+    def test_new_comment_bid_and_edit_refresh_fragments(self):
+        """
+        New comment, accepted bid and listing's edit make cached fragments outdated
+        """
+        self.client.get(self.url)
+        self.add_comments(1)
+        self.assertContains(self.client.get(self.url), "comment_0")
+
+        place_bid(self.listing, self.bidder, 150)
+        self.assertContains(self.client.get(self.url), "$150.00")
+
+        self.listing.description = "new_description"
+        self.listing.save()
+        self.assertContains(self.client.get(self.url), "new_description")
+
+    def test_settlement_refreshes_fragments(self):
+        """
+        Settled listing isn't rendered as active from cached bid box
+        """
+        self.assertContains(self.client.get(self.url), 'id="is_active"\n                         value="True"')
+        settle_listings(AuctionListing.objects.filter(id=self.listing.id))
+        self.assertContains(self.client.get(self.url), 'id="is_active"\n                         value="False"')
+
+    def test_fragments_shared_by_users(self):
+        """
+        Fragments don't contain user's data, owner's controls are rendered for owner only
+        """
+        self.client.get(self.url)
+        self.assertNotContains(self.client.get(self.url), 'id="edit-listing"')
+        self.client.login(username="test_user", password="password")
+        self.assertContains(self.client.get(self.url), 'id="edit-listing"')
+
+
+class ListingCommentsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = create_user(username="test_user", password="password")
+        self.category = create_category(name="test_category")
+        self.listing = create_listing(name="test_listing", image="None", description="test_desc",
+                                      category=self.category, user=self.owner, startBid=100, days=30, active=True)
+        self.client.login(username="test_user", password="password")
+
+    def add_comments(self, count, date=None):
+        """
+        Add "count" comments of different users, all comments get the same date if "date" is given
+        """
+        comments = []
+        for i in range(count):
+            user = create_user(username=f"commenter_{self.listing.comment_set.count()}", password="password")
+            comments.append(Comment.objects.create(listing=self.listing, user=user, date=date or timezone.now(),
+                                                   text=f"comment_{self.listing.comment_set.count()}"))
+        return comments
+
+    def get_details_queries_count(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("market:details", kwargs={"listing_id": self.listing.id}))
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_details_renders_newest_comments(self):
+        """
+        Details page renders only the newest comments in chronological order and total count of comments
+        """
+        comments = self.add_comments(5)
+        with self.settings(COMMENTS_PAGE_SIZE=3):
+            response = self.client.get(reverse("market:details", kwargs={"listing_id": self.listing.id}))
+        self.assertEqual(list(response.context["comments"]), comments[:1:-1])
+        self.assertContains(response, "Comments (5)")
+        self.assertContains(response, f'id="oldest-comment-id" value="{comments[2].id}"')
+        self.assertNotContains(response, "comment_1<")
+
+    def test_details_queries_count_does_not_depend_on_comments_count(self):
+        """
+        Comments' users are loaded with comments, page with 2 and with 30 comments costs the same number of queries
+        """
+        self.add_comments(2)
+        small = self.get_details_queries_count()
+        self.add_comments(28)
+        self.assertEqual(small, self.get_details_queries_count())
+
+    def test_older_comments_pages(self):
+        """
+        Older comments are returned page by page from the newest to the oldest,
+        comments with the same date are split by id
+        """
+        comments = self.add_comments(7, date=timezone.now())
+        url = reverse("market:listing_comments", kwargs={"listing_id": self.listing.id})
+        loaded = []
+        with self.settings(COMMENTS_PAGE_SIZE=3):
+            before = comments[-1].id
+            while before:
+                response = self.client.get(url, {"before": before})
+                self.assertEqual(response.status_code, 200)
+                loaded += [comment["id"] for comment in response.json()["results"]]
+                before = response.json()["next"]
+        self.assertEqual(loaded, [comment.id for comment in comments[-2::-1]])
+        self.assertEqual(response.json()["results"][-1]["user"]["username"], comments[0].user.username)
+
+    def test_older_comments_wrong_before(self):
+        """
+        "before" which is not a comment of the listing returns 400
+        """
+        other_listing = create_listing(name="other_listing", image="None", description="test_desc",
+                                       category=self.category, user=self.owner, startBid=100, days=30, active=True)
+        other_comment = Comment.objects.create(listing=other_listing, user=self.owner, date=timezone.now(), text="text")
+        url = reverse("market:listing_comments", kwargs={"listing_id": self.listing.id})
+        for before in ("text", other_comment.id):
+            with self.subTest(before=before):
+                self.assertEqual(self.client.get(url, {"before": before}).status_code, 400)
+
+
+class ListingGridQueryCountTests(TestCase):
+    def setUp(self):
+        self.owner = create_user(username="test_user", password="password")
+        self.category = create_category(name="test_category")
+
+    def get_grid_queries_count(self, username, listings_count, url_name):
+        """
+        Create user whose "listings_count" listings are watched, won and own, return queries count of the grid page
+        """
+        AuctionListing.objects.all().delete()
+        user = create_user(username=username, password="password")
+        for i in range(listings_count):
+            listing = create_listing(name=f"listing_{i}", image="None", description="test_desc",
+                                     category=self.category, user=user, startBid=100, days=30, active=True)
+            user.watchlist.add(listing)
+            user.winlist.add(listing)
+        self.client.login(username=username, password="password")
+        kwargs = {"category_id": self.category.id} if url_name == "market:category_listings" else {}
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse(url_name, kwargs=kwargs))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Watching")
+        self.assertNotContains(response, "Not Watching")
+        return len(context)
+
+    def test_grid_queries_count_does_not_depend_on_listings_count(self):
+        """
+        Every listings grid resolves watchlist once and issues the same number of queries for one and for ten listings
+        """
+        for url_name in ("market:index", "market:active", "market:category_listings", "market:mylistings",
+                         "market:watchlist", "market:winlist"):
+            with self.subTest(url_name=url_name):
+                self.assertEqual(self.get_grid_queries_count(f"{url_name}_1", 1, url_name),
+                                 self.get_grid_queries_count(f"{url_name}_10", 10, url_name))
+
+
+class ListingGridPaginationTests(TestCase):
+    def setUp(self):
+        self.owner = create_user(username="test_user", password="password")
+        self.category = create_category(name="test_category")
+        date = timezone.now()
+        self.listings = []
+        for i in range(7):
+            listing = create_listing(name=f"listing_{i}", image="None", description="test_desc",
+                                     category=self.category, user=self.owner, startBid=100 + i % 3, days=30,
+                                     active=True)
+            # Pairs of listings share dates and prices, so pages are split by id
+            listing.creationDate = date + datetime.timedelta(minutes=i // 2)
+            listing.endDate = date + datetime.timedelta(days=1, minutes=i // 2)
+            listing.save()
+            self.listings.append(listing)
+
+    def get_all_pages(self, url_name, sort, **kwargs):
+        ids = []
+        params = {"sort": sort}
+        while True:
+            response = self.client.get(reverse(url_name, kwargs=kwargs), params)
+            self.assertEqual(response.status_code, 200)
+            ids += [listing.id for listing in response.context["active_listing_list"]]
+            if not response.context["next_cursor"]:
+                return ids
+            params["cursor"] = response.context["next_cursor"]
+
+    def test_pages_in_sort_order(self):
+        """
+        Every listing is shown once, page by page, in chosen sort order
+        """
+        expected = {
+            "ending": [listing.id for listing in sorted(self.listings, key=lambda item: (item.endDate, item.id))],
+            "newest": [listing.id for listing in sorted(self.listings, key=lambda item: (item.creationDate, item.id),
+                                                        reverse=True)],
+            "price": [listing.id for listing in sorted(self.listings, key=lambda item: (item.current_price, item.id))],
+        }
+        grids = {
+            ("market:index", ()): ("ending", "newest"),
+            ("market:active", ()): ("ending", "newest", "price"),
+            ("market:category_listings", (("category_id", self.category.id),)): ("ending", "newest"),
+        }
+        with self.settings(LISTINGS_PAGE_SIZE=3):
+            for (url_name, kwargs), sorts in grids.items():
+                for sort in sorts:
+                    with self.subTest(sort=sort, url_name=url_name):
+                        self.assertEqual(self.get_all_pages(url_name, sort, **dict(kwargs)), expected[sort])
+
+    def test_price_sort_only_on_active_grid(self):
+        """
+        Grids without price index fall back to ending soonest and don't offer price sort
+        """
+        response = self.client.get(reverse("market:index"), {"sort": "price"})
+        self.assertEqual(response.context["sort"], "ending")
+        self.assertNotContains(response, "?sort=price")
+        self.assertContains(self.client.get(reverse("market:active")), "?sort=price")
+
+    def test_json_pages(self):
+        """
+        JSON variant returns the same page with cursor of the next page
+        """
+        with self.settings(LISTINGS_PAGE_SIZE=3):
+            response = self.client.get(reverse("market:active"), {"sort": "price", "format": "json"})
+            page = response.json()
+            self.assertEqual([listing["id"] for listing in page["results"]],
+                             [self.listings[0].id, self.listings[3].id, self.listings[6].id])
+            self.assertEqual(page["results"][0]["price"], "100.00")
+            self.assertFalse(page["results"][0]["watched"])
+            response = self.client.get(reverse("market:active"), {"sort": "price", "format": "json",
+                                                                  "cursor": page["next"]})
+            self.assertEqual([listing["id"] for listing in response.json()["results"]],
+                             [self.listings[1].id, self.listings[4].id, self.listings[2].id])
+
+    def test_invalid_cursor(self):
+        """
+        Broken cursor returns 400, unknown sort falls back to ending soonest
+        """
+        self.assertEqual(self.client.get(reverse("market:index"), {"cursor": "broken"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("market:index"), {"sort": "unknown"}).context["sort"], "ending")
+
+    def test_tampered_cursor(self):
+        """
+        Well-formed cursor with values which don't fit sort fields returns 400 on every grid
+        """
+        urls = (reverse("market:index"), reverse("market:active"),
+                reverse("market:category_listings", kwargs={"category_id": self.category.id}))
+        for url in urls:
+            for sort in ("ending", "newest", "price"):
+                with self.subTest(url=url, sort=sort):
+                    response = self.client.get(url, {"sort": sort, "cursor": encode_cursor("garbage", 1)})
+                    self.assertEqual(response.status_code, 400)
+
+    def test_price_sort_without_current_price(self):
+        """
+        Listing whose current_price was never backfilled is sorted and paged by its start bid
+        """
+        AuctionListing.objects.filter(id__in=[self.listings[1].id, self.listings[3].id]).update(current_price=None)
+        expected = [listing.id for listing in sorted(self.listings, key=lambda item: (item.startBid, item.id))]
+        with self.settings(LISTINGS_PAGE_SIZE=3):
+            self.assertEqual(self.get_all_pages("market:active", "price"), expected)
+            page = self.client.get(reverse("market:active"), {"sort": "price", "format": "json"}).json()
+            self.assertEqual([listing["price"] for listing in page["results"]], ["100.00"] * 3)
+
+
+class MyBidsViewTests(TestCase):
+    def setUp(self):
+        self.owner = create_user(username="test_user", password="password")
+        self.bidder = create_user(username="test_user_2", password="password")
+        self.rival = create_user(username="test_user_3", password="password")
+        self.category = create_category(name="test_category")
+        self.client.login(username="test_user_2", password="password")
+
+    def create_listings_with_bids(self, count):
+        """
+        Create "count" listings where bidder made two bids, bidder leads on even listings and is outbid on odd ones
+        """
+        listings = []
+        for i in range(count):
+            listing = create_listing(name=f"listing_{i}", image="None", description="test_desc",
+                                     category=self.category, user=self.owner, startBid=100, days=30 + i, active=True)
+            place_bid(listing, self.bidder, 110)
+            place_bid(listing, self.bidder, 120)
+            if i % 2:
+                place_bid(listing, self.rival, 130)
+            listings.append(listing)
+        return listings
+
+    def get_mybids_queries_count(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("market:mybids"))
+        self.assertEqual(response.status_code, 200)
+        return len(context)
+
+    def test_no_bids(self):
+        """
+        If user made no bids - redirect to index page
+        """
+        self.assertRedirects(self.client.get(reverse("market:mybids")), reverse("market:index"))
+
+    def test_listings_with_max_bid_and_leading(self):
+        """
+        Every listing with user's bids is shown once with user's max bid and whether user leads
+        """
+        listings = self.create_listings_with_bids(3)
+        create_listing(name="not_my_listing", image="None", description="test_desc", category=self.category,
+                       user=self.owner, startBid=100, days=30, active=True)
+        response = self.client.get(reverse("market:mybids"))
+        self.assertEqual([(listing.id, listing.my_max_bid, listing.is_leading)
+                          for listing in response.context["active_listing_list"]],
+                         [(listing.id, 120, i % 2 == 0) for i, listing in enumerate(listings)])
+        self.assertContains(response, "Leading", count=2)
+        self.assertContains(response, "Outbid", count=1)
+        self.assertNotContains(response, "not_my_listing")
+
+    def test_pages(self):
+        """
+        Listings are paginated, the next page continues after the last listing of the previous one
+        """
+        listings = self.create_listings_with_bids(5)
+        with self.settings(LISTINGS_PAGE_SIZE=3):
+            page = self.client.get(reverse("market:mybids"), {"format": "json"}).json()
+            next_page = self.client.get(reverse("market:mybids"), {"format": "json", "cursor": page["next"]}).json()
+        self.assertEqual([listing["id"] for listing in page["results"] + next_page["results"]],
+                         [listing.id for listing in listings])
+        self.assertEqual(page["results"][1]["my_max_bid"], "120.00")
+        self.assertFalse(page["results"][1]["is_leading"])
+        self.assertIsNone(next_page["next"])
+
+    def test_queries_count_does_not_depend_on_bids_count(self):
+        """
+        Page with one and with ten listings with bids costs the same number of queries
+        """
+        self.create_listings_with_bids(1)
+        small = self.get_mybids_queries_count()
+        self.create_listings_with_bids(9)
+        self.assertEqual(small, self.get_mybids_queries_count())
+
+
+class InboxCounterTests(TestCase):
+    def setUp(self):
+        self.user_1 = create_user(username="test_user_1", password="password_1")
+        self.user_2 = create_user(username="test_user_2", password="password_2")
+        self.chat = Chat.objects.create()
+        self.chat.members.add(self.user_1, self.user_2)
+
+    def get_inbox(self, user):
+        return User.objects.values_list("inbox", flat=True).get(pk=user.pk)
+
+    def test_new_message_increments_receiver_inbox(self):
+        """
+        Every new unread message increments inbox counter of receiver only
+        """
+        Message.objects.create(text="message_1", sender=self.user_2, receiver=self.user_1, chat=self.chat)
+        Message.objects.create(text="message_2", sender=self.user_2, receiver=self.user_1, chat=self.chat)
+        self.assertEqual(self.get_inbox(self.user_1), 2)
+        self.assertEqual(self.get_inbox(self.user_2), 0)
+
+    def test_opening_chat_decrements_inbox_without_count_query(self):
+        """
+        Opening chat marks its messages read and decreases inbox by their number, layout badge shows new value
+        """
+        other_chat = Chat.objects.create()
+        other_member = create_user(username="test_user_3", password="password_3")
+        other_chat.members.add(self.user_1, other_member)
+        Message.objects.create(text="message_1", sender=self.user_2, receiver=self.user_1, chat=self.chat)
+        Message.objects.create(text="message_2", sender=self.user_2, receiver=self.user_1, chat=self.chat)
+        Message.objects.create(text="message_3", sender=other_member, receiver=self.user_1, chat=other_chat)
+        self.client.login(username="test_user_1", password="password_1")
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("market:chat", kwargs={"chat_id": self.chat.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_inbox(self.user_1), 1)
+        self.assertEqual(response.context["user"].inbox, 1)
+        self.assertFalse([query for query in context.captured_queries
+                          if 'SELECT COUNT(*) AS "__count" FROM "market_message"' in query['sql']])
+        self.client.get(reverse("market:chat", kwargs={"chat_id": self.chat.id}))
+        self.assertEqual(self.get_inbox(self.user_1), 1)
+
+    def test_settlement_increments_winners_inbox(self):
+        """
+        Winner message created by settlement is counted in winner's inbox
+        """
+        category = create_category(name="category_1")
+        listing = create_listing(name="listing_1", image="None", description="test_desc", category=category,
+                                 user=self.user_1, startBid=100, days=-1, active=True)
+        Bid.objects.create(value=150, listing=listing, user=self.user_2, date=timezone.now())
+        settle_listings(AuctionListing.objects.filter(id=listing.id))
+        self.assertEqual(self.get_inbox(self.user_2), 1)
+        self.assertEqual(self.get_inbox(self.user_1), 0)
+
+    def test_sync_user_inbox_command_repairs_counter(self):
+        """
+        sync_user_inbox command restores inbox counters that went out of date
+        """
+        Message.objects.create(text="message_1", sender=self.user_2, receiver=self.user_1, chat=self.chat)
+        User.objects.filter(pk=self.user_1.pk).update(inbox=5)
+        User.objects.filter(pk=self.user_2.pk).update(inbox=3)
+        out = StringIO()
+        call_command("sync_user_inbox", "--batch-size", "1", stdout=out)
+        self.assertEqual(self.get_inbox(self.user_1), 1)
+        self.assertEqual(self.get_inbox(self.user_2), 0)
+        self.assertIn("Checked 2 users, repaired 2", out.getvalue())
+
+
+class NavBadgesTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = create_user(username="test_user_1", password="password_1")
+        self.other_user = create_user(username="test_user_2", password="password_2")
+        self.category = create_category(name="category_1")
+        self.listing = create_listing(name="listing_1", image="None", description="test_desc", category=self.category,
+                                      user=self.other_user, startBid=100, days=-1, active=True)
+        self.client.login(username="test_user_1", password="password_1")
+
+    def get_badges(self):
+        return self.client.get(reverse("market:categories")).context["nav_badges"]
+
+    def test_navigation_costs_no_queries_on_cache_hit(self):
+        """
+        Second page render takes navigation badges from the cache without queries of watchlist, winlist, bids or listings
+        """
+        self.client.get(reverse("market:categories"))
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("market:categories"))
+        self.assertContains(response, "Watchlist")
+        self.assertFalse([query for query in context.captured_queries
+                          if any(table in query['sql'] for table in
+                                 ('market_user_watchlist', 'market_user_winlist', 'market_bid', 'market_auctionlisting'))])
+
+    def test_watchlist_toggle_invalidates_badges(self):
+        """
+        Adding listing to watchlist and removing it updates watchlist badge
+        """
+        self.assertEqual(self.get_badges()["watchlist_count"], 0)
+        self.client.post(reverse("market:watchlist"), {"listing_id": self.listing.id})
+        self.assertEqual(self.get_badges()["watchlist_count"], 1)
+        self.client.post(reverse("market:watchlist"), {"listing_id": self.listing.id})
+        self.assertEqual(self.get_badges()["watchlist_count"], 0)
+
+    def test_bid_listing_and_settlement_invalidate_badges(self):
+        """
+        First bid shows My Bids, own listing shows My Listings, won listing shows Won badge
+        """
+        badges = self.get_badges()
+        self.assertFalse(badges["has_bids"])
+        self.assertFalse(badges["has_listings"])
+        Bid.objects.create(value=150, listing=self.listing, user=self.user, date=timezone.now())
+        create_listing(name="listing_2", image="None", description="test_desc", category=self.category,
+                       user=self.user, startBid=100, days=30, active=True)
+        badges = self.get_badges()
+        self.assertTrue(badges["has_bids"])
+        self.assertTrue(badges["has_listings"])
+        self.assertEqual(badges["winlist_count"], 0)
+        settle_listings(AuctionListing.objects.filter(id=self.listing.id))
+        response = self.client.get(reverse("market:categories"))
+        self.assertEqual(response.context["nav_badges"]["winlist_count"], 1)
+        self.assertContains(response, reverse("market:winlist"))
+
+
+class SharedCacheCheckTests(TestCase):
+    def test_process_local_cache_warning(self):
+        """
+        Production settings with process local cache get warning, because Celery invalidates cached badges
+        """
+        locmem = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+        redis = {"default": {"BACKEND": "django_redis.cache.RedisCache", "LOCATION": "redis://localhost:6379/1"}}
+        with self.settings(DEBUG=False, CACHES=locmem):
+            self.assertEqual([warning.id for warning in shared_cache_check(None)], ["market.W001"])
+        with self.settings(DEBUG=False, CACHES=redis):
+            self.assertEqual(shared_cache_check(None), [])
+        with self.settings(DEBUG=True, CACHES=locmem):
+            self.assertEqual(shared_cache_check(None), [])
+
+
+class WatchlistToggleTests(TestCase):
+    def setUp(self):
+        self.user = create_user(username="test_user_1", password="password_1")
+        self.owner = create_user(username="test_user_2", password="password_2")
+        self.category = create_category(name="category_1")
+        self.listing = create_listing(name="listing_1", image="None", description="test_desc", category=self.category,
+                                      user=self.owner, startBid=100, days=30, active=True)
+        self.client.login(username="test_user_1", password="password_1")
+
+    def toggle(self):
+        return self.client.post(reverse("market:watchlist"), {"listing_id": self.listing.id, "format": "json"})
+
+    def test_json_toggle(self):
+        """
+        AJAX toggle returns new state of the listing in user's watchlist
+        """
+        self.assertEqual(self.toggle().json(), {"listing_id": self.listing.id, "watched": True})
+        self.assertQuerysetEqual(self.user.watchlist.all(), [self.listing])
+        self.assertTrue(self.client.get(reverse("market:details", kwargs={"listing_id": self.listing.id})
+                                        ).context["is_watched"])
+        self.assertEqual(self.toggle().json(), {"listing_id": self.listing.id, "watched": False})
+        self.assertQuerysetEqual(self.user.watchlist.all(), [])
+
+    def get_toggle_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            self.toggle()
+        return [query["sql"] for query in context.captured_queries]
+
+    def test_toggle_cost_does_not_depend_on_watchlist_size(self):
+        """
+        Toggle issues the same queries for empty and for long watchlist and never writes the user row
+        """
+        small = self.get_toggle_queries()
+        self.toggle()
+        for i in range(10):
+            self.user.watchlist.add(create_listing(name=f"listing_{i}", image="None", description="test_desc",
+                                                   category=self.category, user=self.owner, startBid=100, days=30,
+                                                   active=True))
+        big = self.get_toggle_queries()
+        self.assertEqual(len(small), len(big))
+        self.assertFalse([sql for sql in small + big if sql.startswith('UPDATE "market_user"')])
+        self.assertFalse([sql for sql in small + big if 'market_user_watchlist' in sql and sql.startswith('SELECT')])
+
+
+class NotifyEndingSoonTests(TestCase):
+    def setUp(self):
+        self.owner = create_user(username="test_user_1", password="password_1")
+        self.category = create_category(name="category_1")
+
+    def create_watched_listing(self, name, watchers_count, minutes):
+        listing = create_listing(name=name, image="None", description="test_desc", category=self.category,
+                                 user=self.owner, startBid=100, days=0, active=True)
+        AuctionListing.objects.filter(pk=listing.pk).update(
+            endDate=timezone.now() + datetime.timedelta(minutes=minutes)
+        )
+        for i in range(watchers_count):
+            create_user(username=f"{name}_watcher_{i}", password="password").watchlist.add(listing)
+        return listing
+
+    def test_listing_is_notified_once(self):
+        """
+        Only listings ending within the window are notified, and every listing only once
+        """
+        ending = self.create_watched_listing("ending", 2, minutes=2)
+        self.create_watched_listing("later", 2, minutes=60)
+        self.assertEqual(notify_ending_soon(), 1)
+        self.assertEqual(notify_ending_soon(), 0)
+        self.assertQuerysetEqual(AuctionListing.objects.filter(ending_notified=True), [ending])
+
+    def get_notify_queries_count(self, watchers_count):
+        self.create_watched_listing(f"listing_{watchers_count}", watchers_count, minutes=2)
+        with CaptureQueriesContext(connection) as context:
+            notify_ending_soon()
+        return len(context)
+
+    def test_queries_count_grows_by_chunks_not_by_watchers(self):
+        """
+        Watchers are read in chunks, one query per chunk instead of one per watcher
+        """
+        with self.settings(WATCHERS_NOTIFY_CHUNK_SIZE=4):
+            one_chunk = self.get_notify_queries_count(3)
+            three_chunks = self.get_notify_queries_count(10)
+        self.assertEqual(three_chunks, one_chunk + 2)
+
+
+class BulkListingsCommandTests(TestCase):
+    def setUp(self):
+        self.user = create_user(username="test_user_1", password="password_1")
+        self.category = create_category(name="category_1")
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def write_file(self, suffix, text):
+        path = os.path.join(self.directory.name, f"listings{suffix}")
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            file.write(text)
+        return path
+
+    def run_command(self, *args):
+        out = StringIO()
+        err = StringIO()
+        call_command("bulk_listings", *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_csv_import_validates_rows_like_create_listing(self):
+        """
+        Valid rows are created with start price as current price, invalid rows are reported with createListing messages
+        """
+        path = self.write_file(".csv", "name,description,startBid,hours,image,category\n"
+                                       f"listing_1,test_desc,100,24,,{self.category.id}\n"
+                                       f"{'n' * 33},test_desc,100,24,,{self.category.id}\n"
+                                       f"listing_3,test_desc,0,24,,{self.category.id}\n"
+                                       "listing_4,test_desc,100,24,,999\n"
+                                       f"listing_5,test_desc,abc,24,,{self.category.id}\n"
+                                       f"listing_6,test_desc,200.5,48,http://image,{self.category.id}\n"
+                                       f"listing_7,test_desc,nan,24,,{self.category.id}\n"
+                                       f"listing_8,test_desc,100,100000000000,,{self.category.id}\n"
+                                       f"listing_9,test_desc,100,2000000000,,{self.category.id}\n")
+        out, err = self.run_command("import", path, "--user", "test_user_1", "--chunk-size", "2")
+        listings = AuctionListing.objects.order_by("id")
+        self.assertEqual([(listing.name, listing.current_price, listing.user) for listing in listings],
+                         [("listing_1", 100, self.user), ("listing_6", Decimal("200.50"), self.user)])
+        self.assertEqual(listings[0].image, NO_IMAGE_URL)
+        self.assertEqual(listings[1].endDate - listings[1].creationDate, datetime.timedelta(hours=48))
+        self.assertIn("Imported 2 listings, rejected 7", out)
+        self.assertIn("rows/s", out)
+        self.assertIn("Row 2 rejected: Name for listing is too long", err)
+        self.assertIn("Row 4 rejected: You didn't select a category", err)
+        self.assertIn("Row 5 rejected: All fields must be filled in", err)
+        self.assertIn("Row 7 rejected: Listing Start Price must be bigger", err)
+        self.assertIn("Row 8 rejected: Listing expire time is out of range", err)
+        self.assertIn("Row 9 rejected: Listing expire time is out of range", err)
+
+    def test_jsonl_import_queries_count_does_not_depend_on_rows_count(self):
+        """
+        Chunk of rows costs one insert, not one query per listing
+        """
+        row = {"name": "listing", "description": "test_desc", "startBid": "100", "hours": 24,
+               "category": self.category.id}
+        for count in (1, 50):
+            path = self.write_file(".jsonl", "".join(json.dumps(row) + "\n" for _ in range(count)) + "broken\n")
+            with CaptureQueriesContext(connection) as context:
+                out, err = self.run_command("import", path, "--user", "test_user_1")
+            self.assertIn(f"Imported {count} listings, rejected 1", out)
+            self.assertEqual(len(context), 3)
+        self.assertEqual(AuctionListing.objects.count(), 51)
+
+    def test_export_listings_and_bids(self):
+        """
+        Listings and bids are exported as JSON Lines or CSV with a header
+        """
+        listing = create_listing(name="listing_1", image="None", description="test_desc", category=self.category,
+                                 user=self.user, startBid=100, days=30, active=True)
+        bidder = create_user(username="test_user_2", password="password_2")
+        bid = place_bid(listing, bidder, 150).bid
+        path = os.path.join(self.directory.name, "listings.jsonl")
+        out, err = self.run_command("export", path)
+        self.assertIn("Exported 1 listings", out)
+        with open(path, encoding="utf-8") as file:
+            rows = [json.loads(line) for line in file]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual((rows[0]["id"], rows[0]["user"], rows[0]["current_price"], rows[0]["bid_count"]),
+                         (listing.id, "test_user_1", "150.00", 1))
+        out, err = self.run_command("export", "-", "--model", "bids", "--format", "csv")
+        self.assertEqual(out.splitlines()[:2], ["id,listing,user,value,date",
+                                                f"{bid.id},{listing.id},test_user_2,150.00,{bid.date}"])
+        self.assertIn("Exported 1 bids", err)
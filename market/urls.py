@@ -30,5 +30,6 @@ urlpatterns = [
     path('signup/', signup, name='signup'),
     path('api/<int:listing_id>/last_bid', GetListingBidInfoView.as_view()),
     path('api/<int:listing_id>/all_bids', GetListingBidsTotalInfoView.as_view()),
+    path('api/<int:listing_id>/comments', GetListingCommentsView.as_view(), name='listing_comments'),
     path('task/<task_id>', get_status, name="get_task_status"),
 ]
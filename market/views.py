@@ -1,26 +1,35 @@
-import datetime
 import json
 import string
 
 from celery.result import AsyncResult
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
+from django.core.cache import cache
 from django.db import IntegrityError
-from django.db.models import Max
-from django.http import HttpResponseRedirect, JsonResponse
+from django.db.models import BooleanField, Count, ExpressionWrapper, Max, OuterRef, Prefetch, Q, Subquery
+from django.http import HttpResponseBadRequest, HttpResponseRedirect, JsonResponse
 from django.shortcuts import render, get_object_or_404
 from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date
 from django.views import generic
 from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import ValidationError
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from . import bidding
+from .bidding import place_bid
+from .events import last_seq
 from .forms import UserAvatarForm
+from .listings import FIELDS_MISSING, clean_listing
 from .models import *
-from .serializers import BidSerializer
-from .tasks import create_task
+from .pagination import encode_cursor, keyset_page, keyset_q
+from .serializers import BidSerializer, CommentSerializer
 
 
 # Checks if given string contains other symbols that are allowed
@@ -29,33 +38,171 @@ def uses_other_chars(s, given=frozenset(string.ascii_letters + string.digits + "
 
 
 class GetListingBidsTotalInfoView(APIView):
+    """
+    Listing's bids ordered by (date, id), page by page.
+    "cursor" continues from the last bid of the previous response, "since" returns only bids made after given date.
+    Response is validated by ETag and Last-Modified of listing's latest bid, so unchanged polls get 304.
+    """
+    page_size = 50
+    max_page_size = 500
+
+    def get(self, request, listing_id):
+        listing = get_object_or_404(AuctionListing.objects.select_related("leading_bid"), pk=listing_id)
+        etag = f'"bids-{listing.id}-{listing.bid_count}-{listing.leading_bid_id}"'
+        last_modified = listing.leading_bid and listing.leading_bid.date
+        not_modified = get_conditional_response(
+            request, etag=etag, last_modified=last_modified and int(last_modified.timestamp())
+        )
+        if not_modified is not None:
+            return not_modified
+
+        bids = Bid.objects.filter(listing=listing).select_related("user")
+        since = request.query_params.get("since")
+        if since:
+            since_date = parse_datetime(since)
+            if since_date is None:
+                raise ValidationError({"since": "Date must be in ISO 8601 format."})
+            if timezone.is_naive(since_date):
+                since_date = timezone.make_aware(since_date)
+            bids = bids.filter(date__gt=since_date)
+        try:
+            page_size = min(int(request.query_params.get("page_size", self.page_size)), self.max_page_size)
+        except ValueError:
+            raise ValidationError({"page_size": "Page size must be integer."})
+        cursor = request.query_params.get("cursor")
+        try:
+            page, has_next = keyset_page(bids, ("date", "id"), cursor, max(page_size, 1))
+        except ValueError:
+            raise ValidationError({"cursor": "Invalid cursor."})
+
+        if page:
+            cursor = encode_cursor(page[-1].date.isoformat(), page[-1].id)
+        next_url = None
+        if has_next:
+            query = request.query_params.copy()
+            query["cursor"] = cursor
+            next_url = request.build_absolute_uri(f"{request.path}?{query.urlencode()}")
+        response = Response({
+            "results": BidSerializer(instance=page, many=True).data,
+            "next": next_url,
+            "cursor": cursor,
+        })
+        response["ETag"] = etag
+        if last_modified:
+            response["Last-Modified"] = http_date(last_modified.timestamp())
+        patch_cache_control(response, no_cache=True)
+        return response
+
+
+class GetListingBidInfoView(APIView):
+    """
+    Listing's leading bid from one query of the listing joined with the bid and its user.
+    Response is cached for LAST_BID_CACHE_TTL seconds, accepted bid drops the cache.
+    Latency budget: 5 ms per cached and 15 ms per uncached request, checked by LastBidApiTests with RUN_BENCHMARKS=1.
+    """
+
     @staticmethod
     def get(request, listing_id):
-        listing = get_object_or_404(AuctionListing, pk=listing_id)
-        bids = Bid.objects.filter(listing=listing)
-        if not bids:
-            pass
-        else:
-            all_bids = Bid.objects.filter(listing=listing).order_by("date")
-            queryset = all_bids
-            serializer_for_queryset = BidSerializer(instance=queryset, many=True)
-            return Response(serializer_for_queryset.data)
-        return Response(json.dumps({"value": "No bids yet :)"}))
+        key = last_bid_cache_key(listing_id)
+        data = cache.get(key)
+        if data is None:
+            listing = get_object_or_404(AuctionListing.objects.select_related("leading_bid__user"), pk=listing_id)
+            if listing.leading_bid is not None:
+                data = BidSerializer(instance=listing.leading_bid, many=False).data
+            else:
+                data = json.dumps({"value": "No bids yet :)"})
+            cache.set(key, data, timeout=settings.LAST_BID_CACHE_TTL)
+        return Response(data)
 
 
-class GetListingBidInfoView(APIView):
+class GetListingCommentsView(APIView):
+    """
+    Listing's comments from the newest to the oldest, page by page.
+    "before" is id of the oldest comment client already has, "next" is the value for the next page.
+    """
+
     @staticmethod
     def get(request, listing_id):
-        listing = get_object_or_404(AuctionListing, pk=listing_id)
-        bids = Bid.objects.filter(listing=listing)
-        if not bids:
-            pass
-        else:
-            last_bid = Bid.objects.filter(listing=listing).order_by("-value")[0]
-            queryset = last_bid
-            serializer_for_queryset = BidSerializer(instance=queryset, many=False)
-            return Response(serializer_for_queryset.data)
-        return Response(json.dumps({"value": "No bids yet :)"}))
+        comments = Comment.objects.filter(listing_id=listing_id).select_related("user")
+        before = request.query_params.get("before")
+        if before:
+            try:
+                oldest = Comment.objects.filter(listing_id=listing_id).values("date", "id").get(pk=int(before))
+            except (ValueError, Comment.DoesNotExist):
+                raise ValidationError({"before": "Comment of the listing doesn't exist."})
+            comments = comments.filter(keyset_q(("date", "id"), (oldest["date"], oldest["id"]), descending=True))
+        page, has_next = keyset_page(comments, ("date", "id"), page_size=settings.COMMENTS_PAGE_SIZE, descending=True)
+        return Response({
+            "results": CommentSerializer(instance=page, many=True, context={"request": request}).data,
+            "next": page[-1].id if has_next else None,
+        })
+
+
+def watched_listing_ids(user):
+    """
+    Return set of ids of listings in user's watchlist, one query for the whole listings grid.
+    """
+    if not user.is_authenticated:
+        return set()
+    return set(User.watchlist.through.objects.filter(user_id=user.id).values_list("auctionlisting_id", flat=True))
+
+
+# Sort orders of listings grids: ordering fields (unique by id) and direction
+LISTING_GRID_SORTS = {
+    "ending": (("endDate", "id"), False),
+    "newest": (("creationDate", "id"), True),
+    "price": (("price", "id"), False),
+}
+# Sorts backed by indexes of every grid (see AuctionListing.Meta.indexes). current_price is rewritten by every bid,
+# so only active listings are indexed by price and price sort is offered by grids of active listings only
+INDEXED_GRID_SORTS = ("ending", "newest")
+
+
+def listing_grid(request, listings, sorts=INDEXED_GRID_SORTS, **context):
+    """
+    Render one keyset page of listings grid in chosen "sort" order (one of "sorts"), page after "cursor".
+    With "format=json" return the page as JSON for infinite scroll.
+    """
+    sort = request.GET.get("sort")
+    if sort not in sorts:
+        sort = "ending"
+    fields, descending = LISTING_GRID_SORTS[sort]
+    listings = listings.annotate(price=LISTING_PRICE)
+    try:
+        page, has_next = keyset_page(listings, fields, request.GET.get("cursor"), settings.LISTINGS_PAGE_SIZE,
+                                     descending)
+    except ValueError:
+        return HttpResponseBadRequest("Invalid cursor.")
+    next_cursor = encode_cursor(*[getattr(page[-1], field) for field in fields]) if has_next else None
+    watched_ids = watched_listing_ids(request.user)
+
+    if request.GET.get("format") == "json":
+        return JsonResponse({
+            "results": [
+                {
+                    "id": listing.id,
+                    "name": listing.name,
+                    "image": listing.loaded_image.url if listing.loaded_image else listing.image,
+                    "price": f"{listing.price:.2f}",
+                    "creationDate": listing.creationDate,
+                    "endDate": listing.endDate,
+                    "active": listing.active,
+                    "watched": listing.id in watched_ids,
+                    **({"my_max_bid": f"{listing.my_max_bid:.2f}", "is_leading": listing.is_leading}
+                       if hasattr(listing, "my_max_bid") else {}),
+                }
+                for listing in page
+            ],
+            "next": next_cursor,
+        })
+    context.update({
+        "active_listing_list": page,
+        "watched_ids": watched_ids,
+        "sort": sort,
+        "sorts": sorts,
+        "next_cursor": next_cursor,
+    })
+    return render(request, "market/index.html", context)
 
 
 class IndexView(generic.ListView):
@@ -66,22 +213,31 @@ class IndexView(generic.ListView):
         """Return all listing that exist."""
         return AuctionListing.objects.all()
 
+    def get(self, request, *args, **kwargs):
+        return listing_grid(request, self.get_queryset())
+
 
 def details(request, listing_id):
     server_datetime = timezone.now()
-    listing = get_object_or_404(AuctionListing, pk=listing_id)
+    # Read before the listing, so socket resumes from events which page may not include yet
+    listing_seq = last_seq(listing_id)
+    # Read before the listing too, so fragments aren't cached from data older than the version
+    listing_version = get_listing_version(listing_id)
+    listing = get_object_or_404(AuctionListing.objects.select_related("leading_bid__user"), pk=listing_id)
     bids = Bid.objects.filter(listing=listing)
-    comments = Comment.objects.filter(listing=listing)
-    comments = comments.order_by("date")
-    max_value = bids.aggregate(Max("value"))["value__max"]
-    bid_item = None
+    # Only the newest comments are rendered, older ones are loaded by GetListingCommentsView
+    comments = Comment.objects.filter(listing=listing).select_related("user")
+    comments = comments.order_by("-date", "-id")[:settings.COMMENTS_PAGE_SIZE]
+    bid_item = listing.leading_bid
     true_user = False
 
-    if max_value is not None:
-        bid_item = Bid.objects.filter(value=max_value)[0]
-    if listing.user == request.user:
+    if listing.user_id == request.user.id:
         true_user = True
 
+    is_watched = request.user.is_authenticated and User.watchlist.through.objects.filter(
+        user_id=request.user.id, auctionlisting_id=listing.id
+    ).exists()
+
     min_value = listing.startBid
 
     if bid_item:
@@ -99,6 +255,11 @@ def details(request, listing_id):
             "comments": comments,
             "bid": bid_item,
             "min_value": min_value,
+            "is_watched": is_watched,
+            "listing_seq": listing_seq,
+            "listing_version": listing_version,
+            "fragment_ttl": settings.LISTING_FRAGMENT_CACHE_TTL,
+            "comments_page_size": settings.COMMENTS_PAGE_SIZE,
             "user": request.user,
         },
     )
@@ -115,13 +276,6 @@ def makebid(request, listing_id):
         )
 
     else:
-        bids = Bid.objects.filter(listing=listing)
-        user = request.user
-        date = timezone.now()
-        max_value = bids.aggregate(Max("value"))["value__max"]
-        if max_value is None:
-            max_value = 0
-
         try:
             new_bid = request.POST["newbid"]
         except KeyError:
@@ -130,113 +284,51 @@ def makebid(request, listing_id):
                 reverse("market:details", kwargs={"listing_id": listing.id})
             )
         else:
-            try:
-                new_bid = float(new_bid)
-            except ValueError:
+            result = place_bid(listing, request.user, new_bid)
+            if result.reason == bidding.NON_NUMERIC:
                 messages.warning(request, "You didn't give any value.")
-                return HttpResponseRedirect(
-                    reverse("market:details", kwargs={"listing_id": listing.id})
+            elif not result.accepted:
+                messages.warning(
+                    request,
+                    "Bid Value must be bigger than Start Price and Last Bid.",
                 )
-            else:
-                new_bid = round(float(new_bid), 2)
-                if new_bid > max_value and new_bid > round(float(listing.startBid), 2):
-                    new_bid_object = Bid.objects.create(
-                        value=new_bid, user=user, listing=listing, date=date
-                    )
-                    new_bid_object.save()
-                    return HttpResponseRedirect(
-                        reverse("market:details", kwargs={"listing_id": listing.id})
-                    )
-                else:
-                    messages.warning(
-                        request,
-                        "Bid Value must be bigger than Start Price and Last Bid.",
-                    )
-                    return HttpResponseRedirect(
-                        reverse("market:details", kwargs={"listing_id": listing.id})
-                    )
+            return HttpResponseRedirect(
+                reverse("market:details", kwargs={"listing_id": listing.id})
+            )
 
 
 @login_required
 def createListing(request):
     if request.method == "POST":
-        user = request.user
-        active = True
-        current_date = timezone.now()
         try:
-            hours = int(request.POST["expiretime"])
-            name = f"{request.POST['listingname']}"
-            category = request.POST["category"]
-            startBid = float(request.POST["startBid"])
-            description = f"{request.POST['listingdesc']}"
-        except (KeyError, ValueError):
-            messages.warning(
-                request, "All fields must be filled in, check this out and try again"
-            )
+            fields = {
+                "name": request.POST["listingname"],
+                "description": request.POST["listingdesc"],
+                "start_bid": request.POST["startBid"],
+                "hours": request.POST["expiretime"],
+                "image": request.POST.get("imageurl", ""),
+            }
+        except KeyError:
+            messages.warning(request, FIELDS_MISSING)
             return HttpResponseRedirect(reverse("market:createListing"))
-
         try:
-            image_file = request.FILES.get("loaded-image")
-        except (KeyError, ValueError):
-            image_file = ""
-            pass
-        try:
-            image = f"{request.POST['imageurl']}"
-        except (KeyError, ValueError):
-            image = ""
-        try:
-            category = Category.objects.get(pk=category)
+            category = Category.objects.get(pk=request.POST["category"])
         except (ValueError, KeyError, Category.DoesNotExist):
-            messages.warning(request, "You didn't select a category")
+            category = None
+        try:
+            listing_fields = clean_listing(category=category, **fields)
+        except ValueError as error:
+            messages.warning(request, str(error))
             return HttpResponseRedirect(reverse("market:createListing"))
-        else:
-            if len(name) > 32:
-                messages.warning(
-                    request, "Name for listing is too long, must be less than 33"
-                )
-                return HttpResponseRedirect(reverse("market:createListing"))
-            elif startBid > 99999.00 or startBid < 0.01:
-                messages.warning(
-                    request,
-                    "Listing Start Price must be bigger than 0.01 and less than 99999.00",
-                )
-                return HttpResponseRedirect(reverse("market:createListing"))
-            elif len(description) > 150:
-                messages.warning(request, "Description length must be less than 151")
-                return HttpResponseRedirect(reverse("market:createListing"))
-            else:
-                if not image:
-                    image = (
-                        "https://upload.wikimedia.org/wikipedia/commons/thumb/a/ac/No_image_available.svg/1024px"
-                        "-No_image_available.svg.png"
-                    )
-                end_date = current_date + datetime.timedelta(hours=hours)
-
-                new_listing = AuctionListing.objects.create(
-                    name=name,
-                    description=description,
-                    loaded_image=image_file,
-                    image=image,
-                    category=category,
-                    user=user,
-                    startBid=startBid,
-                    creationDate=current_date,
-                    endDate=end_date,
-                    active=active,
-                )
 
-                new_listing.save()
-                seconds_to_end = int(
-                    datetime.timedelta.total_seconds(
-                        new_listing.endDate - new_listing.creationDate
-                    )
-                )
-                task = create_task.apply_async(
-                    kwargs={"listing_id": new_listing.id}, countdown=seconds_to_end
-                )
-                return HttpResponseRedirect(
-                    reverse("market:details", kwargs={"listing_id": new_listing.id})
-                )
+        new_listing = AuctionListing.objects.create(
+            loaded_image=request.FILES.get("loaded-image"),
+            user=request.user,
+            **listing_fields,
+        )
+        return HttpResponseRedirect(
+            reverse("market:details", kwargs={"listing_id": new_listing.id})
+        )
     return render(
         request, "market/createListing.html", {"categories": Category.objects.all()}
     )
@@ -371,11 +463,9 @@ def watchlist(request):
             listing = get_object_or_404(AuctionListing, pk=request.POST["listing_id"])
         except KeyError:
             return HttpResponseRedirect(reverse("market:index"))
-        if listing not in user.watchlist.all():
-            user.watchlist.add(listing)
-        else:
-            user.watchlist.remove(listing)
-        user.save()
+        watched = user.toggle_watchlist(listing.id)
+        if request.POST.get("format") == "json":
+            return JsonResponse({"listing_id": listing.id, "watched": watched})
         return HttpResponseRedirect(
             reverse("market:details", kwargs={"listing_id": listing.id})
         )
@@ -386,6 +476,7 @@ def watchlist(request):
             {
                 "active_listing_list": user.watchlist.all(),
                 "watchlist": "Watchlist",
+                "watched_ids": watched_listing_ids(user),
             },
         )
 
@@ -409,15 +500,14 @@ def mylistings(request):
         {
             "active_listing_list": AuctionListing.objects.filter(user=user),
             "mylistings": "My Listings",
+            "watched_ids": watched_listing_ids(user),
         },
     )
 
 
 def active_listing(request):
-    return render(request, "market/index.html", {
-        "active_listing_list": AuctionListing.objects.filter(active=True),
-        "active": "Active"
-    })
+    return listing_grid(request, AuctionListing.objects.filter(active=True), sorts=tuple(LISTING_GRID_SORTS),
+                        active="Active")
 
 
 class CategoriesView(generic.ListView):
@@ -431,11 +521,7 @@ class CategoriesView(generic.ListView):
 
 def category_listings(request, category_id):
     category = get_object_or_404(Category, pk=category_id)
-    return render(
-        request,
-        "market/index.html",
-        {"active_listing_list": AuctionListing.objects.filter(category=category)},
-    )
+    return listing_grid(request, AuctionListing.objects.filter(category=category))
 
 
 @login_required
@@ -492,6 +578,7 @@ def winlistings(request):
             {
                 "active_listing_list": user.winlist.all(),
                 "winlist": "Winlist",
+                "watched_ids": watched_listing_ids(user),
             },
         )
 
@@ -509,11 +596,6 @@ class Inbox(APIView):
         """
         user = request.user
 
-        # Get all the chats for that self.user
-        chats = Chat.objects.filter(members=user.id)
-
-        current_chats = []
-
         # Create a blacklist for all the users that have a chat room
         to_exclude = [user.username]
 
@@ -526,57 +608,52 @@ class Inbox(APIView):
                 )
                 return HttpResponseRedirect(reverse("market:inbox"))
             else:
-                get_messages = Message.objects.filter(chat=chat_id).order_by("date")
-                show_messages = [msg.serialize() for msg in get_messages]
-
-                for c in chats:
-                    for msg in c.message_set.exclude(sender_id=user.id):
-                        if c == get_chat:
-                            msg.unread = False
-                            msg.save()
+                get_messages = Message.objects.filter(chat=chat_id).select_related("sender", "receiver")
+                show_messages = [msg.serialize() for msg in get_messages.order_by("date")]
+
+                # Mark messages received in the chat as read, inbox counter is decreased by their number
+                user.inbox -= Message.mark_read(get_chat.id, user.id)
         else:
             show_messages = ""
 
-        for chat in chats:
-            # Get only the last message in each chat
-            all_messages = Message.objects.filter(chat=chat.id).order_by("-date")[:1]
-
-            # Get all unread messages for each chat
-            get_unread = Message.objects.filter(chat=chat.id, unread=True)
-            unread = 0
-
-            # Add 1 to the counter if sender_id and current_user_id are different
-            for u in get_unread:
-                if user.id != u.sender.id:
-                    unread += 1
+        # Get all the chats for that self.user with the last message, unread counter and other members
+        last_message = Message.objects.filter(chat=OuterRef("pk")).order_by("-date", "-id")
+        chats = (
+            Chat.objects.filter(members=user.id)
+            .annotate(
+                last_message=Subquery(last_message.values("text")[:1]),
+                # Same rule as Message.mark_read() and the inbox counter: unread messages received by user
+                unread=Count(
+                    "message", filter=Q(message__unread=True, message__receiver=user.id)
+                ),
+            )
+            .prefetch_related(
+                Prefetch("members", queryset=User.objects.exclude(pk=user.id), to_attr="other_members")
+            )
+            .order_by("id")
+        )
 
-            for c in chat.members.exclude(pk=user.id):
+        current_chats = []
+        for chat in chats:
+            for c in chat.other_members:
                 # Add to the blacklist all the users that have a chat room
                 to_exclude.append(c.username)
 
-                # Get member to access avatar
-                get_receiver = User.objects.get(pk=c.id)
-
                 # Append a dict with information to be used in the inbox page
                 current_chats.append(
                     {
                         "id": chat.id,
                         "receiver_id": c.id,
                         "receiver": c.username,
-                        "avatar": get_receiver.avatar.url if get_receiver.avatar else "",
-                        "preview": [msg.preview() for msg in all_messages],
-                        "unread": unread,
+                        "avatar": c.avatar.url if c.avatar else "",
+                        "preview": [f"{chat.last_message[:10]}..."] if chat.last_message is not None else [],
+                        "unread": chat.unread,
                     }
                 )
 
         # Filter users based on opened chats
         all_users = User.objects.exclude(username__in=to_exclude)
 
-        # Update Inbox Count
-        unread_msgs = Message.objects.filter(receiver=user.id, unread=True)
-        user.inbox = unread_msgs.count()
-        user.save()
-
         return render(
             request,
             "market/inbox.html",
@@ -611,19 +688,15 @@ class Inbox(APIView):
 @login_required
 def mybids(request):
     user = request.user
-    listings = []
-    if user.bid_set.all():
-        for i in user.bid_set.all():
-            if i.listing not in listings:
-                listings.append(i.listing)
-        return render(
-            request,
-            "market/index.html",
-            {
-                "active_listing_list": listings,
-            },
-        )
-    return HttpResponseRedirect(reverse("market:index"))
+    if not user.bid_set.exists():
+        return HttpResponseRedirect(reverse("market:index"))
+    # One row per listing with user's highest bid and whether user's bid is leading now
+    listings = AuctionListing.objects.filter(bid__user=user).annotate(
+        my_max_bid=Max("bid__value"),
+        is_leading=ExpressionWrapper(Q(leading_bid__user=user), output_field=BooleanField()),
+    )
+    # User's own bids are few, so any sort of them is cheap without an index
+    return listing_grid(request, listings, sorts=tuple(LISTING_GRID_SORTS), mybids="My Bids")
 
 
 @login_required
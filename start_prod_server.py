@@ -2,5 +2,7 @@ import subprocess
 
 process2 = subprocess.Popen(["python3", "manage.py", "listing_date_checker"])
 process3 = subprocess.Popen(["celery", "-A", "auctsite", "worker", "-l", "INFO", "--logfile=/home/app/web/logs/celery.log"])
+process4 = subprocess.Popen(["celery", "-A", "auctsite", "beat", "-l", "INFO", "--logfile=/home/app/web/logs/celery-beat.log"])
 process2.wait()
 process3.wait()
+process4.wait()